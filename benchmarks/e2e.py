@@ -0,0 +1,326 @@
+"""End-to-end bot throughput benchmark.
+
+Starts the fake Bot API server (``fakeapi.py``) in process and the bot in
+a subprocess pointed to it, then posts webhook updates to the bot and
+waits for the API calls they cause:
+
+* ``/go`` commands and event messages, answered with ``sendMessage``;
+* inline queries for the created events, answered with
+  ``answerInlineQuery``;
+* storms of "join" button presses on every event message, answered with
+  (coalesced) ``editMessageText`` calls listing the pressing user.
+
+Reports updates per second, p50/p99 latency from posting an update to the
+API call answering it and API calls per update for every phase. The load
+generator and the fake server share the machine with the bot, so compare
+numbers from the same machine only. The bot uses Redis database
+``--redis_db``, which is flushed first. By default the bot runs two
+worker processes, so the multi-process webhook server is exercised.
+
+Calls the bot sends in webhook responses are made by the benchmark, as
+Telegram would, and counted as API calls; compare with
+``--webhook_reply_timeout=0`` to benchmark the bot without them.
+
+    python benchmarks/e2e.py --users=500 --presses=50 --concurrency=100
+    python benchmarks/e2e.py --processes=1
+    python benchmarks/e2e.py --webhook_reply_timeout=0
+"""
+
+import collections
+import os.path
+import subprocess
+import sys
+import time
+
+import simplejson as json
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.httpserver import HTTPServer
+from tornado.options import define, options, parse_command_line
+
+from gopubbot.storage.redis import RedisStorage
+
+from fakeapi import FakeBotApi, make_app
+
+
+define('users', type=int, default=200, help='number of event authors')
+define('presses', type=int, default=20, help='button presses per event')
+define('concurrency', type=int, default=100, help='concurrent updates')
+define('latency', type=float, default=0, help='Bot API latency in ms')
+define('processes', type=int, default=2, help='bot worker processes')
+define('edit_delay', type=float, default=0.05,
+       help='bot event message edit delay in seconds')
+define('webhook_reply_timeout', type=float, default=0.5,
+       help='bot webhook response call timeout in seconds, 0 to disable')
+define('timeout', type=float, default=10,
+       help='seconds to wait for the answer to an update')
+define('redis_db', type=int, default=15, help='Redis database number')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_free_port():
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    for sock in sockets:
+        sock.close()
+    return port
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_user(user_id):
+    return {'id': user_id, 'first_name': 'User',
+            'username': 'u{}'.format(user_id)}
+
+
+class Waiters(object):
+    """Futures waiting for API calls matching a key and a predicate."""
+
+    def __init__(self):
+        self._waiters = collections.defaultdict(list)
+
+    def wait(self, key, predicate=None):
+        future = Future()
+        self._waiters[key].append((predicate, future))
+        return future
+
+    def cancel(self, key, future):
+        waiters = self._waiters.get(key, [])
+        waiters[:] = [w for w in waiters if w[1] is not future]
+
+    def notify(self, key, params):
+        waiters = self._waiters.get(key)
+        if not waiters:
+            return
+        remaining = []
+        for predicate, future in waiters:
+            if predicate is None or predicate(params):
+                future.set_result(params)
+            else:
+                remaining.append((predicate, future))
+        if remaining:
+            waiters[:] = remaining
+        else:
+            del self._waiters[key]
+
+
+class Benchmark(object):
+
+    def __init__(self, api, webhook_port):
+        self.api = api
+        self.webhook_port = webhook_port
+        self.webhook_url = None
+        self.http_client = AsyncHTTPClient(max_clients=options.concurrency)
+        self.waiters = Waiters()
+        self.update_id = 0
+        self.events = {}
+        api.add_listener(self.on_api_call)
+
+    def on_api_call(self, method, params):
+        if method == 'sendMessage':
+            key = ('chat', int(params['chat_id']))
+        elif method == 'answerInlineQuery':
+            key = ('inline', params['inline_query_id'])
+        elif method == 'editMessageText' and 'chat_id' in params:
+            key = ('edit', int(params['chat_id']), int(params['message_id']))
+        else:
+            return
+        self.waiters.notify(key, params)
+
+    @gen.coroutine
+    def wait_webhook(self):
+        while not self.api.webhook_url:
+            yield gen.sleep(0.1)
+        secret = self.api.webhook_url.rsplit('/', 1)[1]
+        self.webhook_url = 'http://127.0.0.1:{}/webhook/{}'.format(
+            self.webhook_port, secret
+        )
+
+    def make_update(self, kind, data):
+        self.update_id += 1
+        return {'update_id': self.update_id, kind: data}
+
+    def make_message(self, user_id, text, entities=None):
+        message = {
+            'message_id': self.update_id + 1,
+            'from': make_user(user_id),
+            'chat': {'id': user_id, 'type': 'private'},
+            'date': int(time.time()),
+            'text': text,
+        }
+        if entities:
+            message['entities'] = entities
+        return self.make_update('message', message)
+
+    @gen.coroutine
+    def post(self, update, key, predicate=None):
+        """Post the update and return seconds until the answer or None."""
+        future = self.waiters.wait(key, predicate)
+        start = time.perf_counter()
+        response = yield self.http_client.fetch(HTTPRequest(
+            self.webhook_url, method='POST', body=json.dumps(update),
+            headers={'Content-Type': 'application/json'},
+        ), raise_error=False)
+        if response.code == 200 and response.body:
+            # A call sent in the webhook response, made by Telegram.
+            call = json.loads(response.body)
+            self.api.call(call.pop('method'), call)
+        elif response.code != 204:
+            self.waiters.cancel(key, future)
+            return None
+        try:
+            yield gen.with_timeout(IOLoop.current().time() + options.timeout,
+                                   future)
+        except gen.TimeoutError:
+            self.waiters.cancel(key, future)
+            return None
+        return time.perf_counter() - start
+
+    @gen.coroutine
+    def run_phase(self, name, jobs):
+        """Run ``jobs``, coroutine functions returning latency, and report."""
+        jobs = collections.deque(jobs)
+        count = len(jobs)
+        latencies = []
+        failed = [0]
+        calls = sum(self.api.calls.values())
+
+        @gen.coroutine
+        def worker():
+            while jobs:
+                latency = yield jobs.popleft()()
+                if latency is None:
+                    failed[0] += 1
+                else:
+                    latencies.append(latency)
+
+        start = time.perf_counter()
+        yield [worker() for i in range(options.concurrency)]
+        elapsed = time.perf_counter() - start
+        calls = sum(self.api.calls.values()) - calls
+        row = '{:<12} {:>7} {:>10.0f} {:>9.1f} {:>9.1f} {:>10.2f} {:>7}'
+        print(row.format(
+            name, count, count / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            calls / count if count else 0, failed[0],
+        ))
+
+    def go_job(self, user_id):
+        update = self.make_message(user_id, '/go', [
+            {'type': 'bot_command', 'offset': 0, 'length': 3},
+        ])
+        return lambda: self.post(update, ('chat', user_id))
+
+    def event_job(self, user_id):
+        update = self.make_message(user_id, 'Pub at 20:00')
+
+        def is_event_message(params):
+            if 'reply_markup' not in params:
+                return False
+            markup = json.loads(params['reply_markup'])
+            data = markup['inline_keyboard'][-1][0]['callback_data']
+            self.events[user_id] = int(data.split(':')[1])
+            return True
+
+        return lambda: self.post(update, ('chat', user_id), is_event_message)
+
+    def inline_job(self, user_id, event_id):
+        update = self.make_update('inline_query', {
+            'id': str(self.update_id + 1),
+            'from': make_user(user_id),
+            'query': str(event_id),
+            'offset': '',
+        })
+        query_id = update['inline_query']['id']
+        return lambda: self.post(update, ('inline', query_id))
+
+    def press_job(self, author_id, event_id, user_id):
+        name = '@u{}'.format(user_id)
+        update = self.make_update('callback_query', {
+            'id': str(self.update_id + 1),
+            'from': make_user(user_id),
+            'message': {
+                'message_id': event_id,
+                'chat': {'id': author_id, 'type': 'private'},
+                'date': int(time.time()),
+            },
+            'chat_instance': str(author_id),
+            'data': 'event_add:{}'.format(event_id),
+        })
+        return lambda: self.post(update, ('edit', author_id, event_id),
+                                 lambda params: name in params['text'])
+
+    @gen.coroutine
+    def run(self):
+        yield self.wait_webhook()
+        users = range(1, options.users + 1)
+        print('{:<12} {:>7} {:>10} {:>9} {:>9} {:>10} {:>7}'.format(
+            'phase', 'updates', 'updates/s', 'p50 ms', 'p99 ms',
+            'calls/upd', 'failed',
+        ))
+        yield self.run_phase('go', [self.go_job(u) for u in users])
+        yield self.run_phase('event', [self.event_job(u) for u in users])
+        events = [(u, self.events[u]) for u in users if u in self.events]
+        yield self.run_phase('inline', [self.inline_job(u, event_id)
+                                        for u, event_id in events])
+        presses = []
+        for i in range(options.presses):
+            for u, event_id in events:
+                user_id = options.users * (i + 1) + u
+                presses.append(self.press_job(u, event_id, user_id))
+        yield self.run_phase('buttons', presses)
+
+
+@gen.coroutine
+def main():
+    storage = RedisStorage(db=options.redis_db)
+    yield storage.execute('FLUSHDB')
+    storage.close()
+
+    api = FakeBotApi(options.latency / 1000)
+    sockets = bind_sockets(0, '127.0.0.1')
+    api_port = sockets[0].getsockname()[1]
+    server = HTTPServer(make_app(api))
+    server.add_sockets(sockets)
+
+    webhook_port = get_free_port()
+    bot = subprocess.Popen([
+        sys.executable, '-m', 'gopubbot.app',
+        '--config=',
+        '--logging=warning',
+        '--bot_api_token=token',
+        '--api_server=http://127.0.0.1:{}'.format(api_port),
+        '--public_server_name=localhost',
+        '--port={}'.format(webhook_port),
+        '--processes={}'.format(options.processes),
+        '--redis_db={}'.format(options.redis_db),
+        '--api_rate=1000000',
+        '--api_chat_rate=1000000',
+        '--api_group_rate=1000000',
+        '--dispatch_queue_size=100000',
+        '--edit_delay={}'.format(options.edit_delay),
+        '--webhook_reply_timeout={}'.format(options.webhook_reply_timeout),
+    ], cwd=ROOT)
+    try:
+        yield Benchmark(api, webhook_port).run()
+    finally:
+        bot.terminate()
+        while bot.poll() is None:
+            yield gen.sleep(0.05)
+        server.stop()
+
+
+if __name__ == '__main__':
+    options.logging = 'warning'
+    parse_command_line()
+    IOLoop.current().run_sync(main)
@@ -0,0 +1,145 @@
+"""Fake Telegram Bot API server.
+
+Implements the methods the bot uses well enough for load tests: messages
+get sequential ids per chat, uploads get file ids and every call is
+reported to listeners. Run it standalone and point the bot to it with
+``--api_server``:
+
+    python benchmarks/fakeapi.py --port=8081 --latency=20
+"""
+
+import collections
+import time
+
+import tornado.web
+from tornado import gen
+from tornado.escape import json_decode
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+
+class FakeBotApi(object):
+    """Fake Bot API state."""
+
+    def __init__(self, latency=0, username='gopubbot'):
+        self.latency = latency
+        self.me = {'id': 1000, 'first_name': 'GoPubBot',
+                   'username': username}
+        self.webhook_url = ''
+        self.calls = collections.Counter()
+        self.listeners = []
+        self._message_ids = collections.Counter()
+        self._file_ids = 0
+
+    def add_listener(self, callback):
+        """Call ``callback(method, params)`` on every API call."""
+        self.listeners.append(callback)
+
+    def next_message(self, chat_id, text=None):
+        self._message_ids[chat_id] += 1
+        message = {
+            'message_id': self._message_ids[chat_id],
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self.me,
+            'date': int(time.time()),
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    def next_file(self):
+        self._file_ids += 1
+        return {'file_id': 'file{}'.format(self._file_ids)}
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        for listener in self.listeners:
+            listener(method, params)
+        handler = getattr(self, 'do_' + method, None)
+        if handler is None:
+            return None
+        return handler(params)
+
+    def do_getMe(self, params):
+        return self.me
+
+    def do_setWebhook(self, params):
+        self.webhook_url = params.get('url', '')
+        return True
+
+    def do_deleteWebhook(self, params):
+        self.webhook_url = ''
+        return True
+
+    def do_getUpdates(self, params):
+        return []
+
+    def do_sendMessage(self, params):
+        return self.next_message(int(params['chat_id']), params['text'])
+
+    def do_editMessageText(self, params):
+        if 'inline_message_id' in params:
+            return True
+        message = self.next_message(int(params['chat_id']), params['text'])
+        message['message_id'] = int(params['message_id'])
+        return message
+
+    def do_answerInlineQuery(self, params):
+        return True
+
+    def do_answerCallbackQuery(self, params):
+        return True
+
+    def do_sendDocument(self, params):
+        message = self.next_message(int(params['chat_id']))
+        message['document'] = self.next_file()
+        return message
+
+    def do_sendPhoto(self, params):
+        message = self.next_message(int(params['chat_id']))
+        message['photo'] = [self.next_file()]
+        return message
+
+
+class FakeBotApiHandler(tornado.web.RequestHandler):
+    """Bot API method handler."""
+
+    def initialize(self, api):
+        self.api = api
+
+    def get_params(self):
+        if self.request.headers.get('Content-Type', '').startswith(
+                'application/json'):
+            return json_decode(self.request.body)
+        return {name: self.get_argument(name)
+                for name in self.request.arguments}
+
+    @gen.coroutine
+    def get(self, token, method):
+        if self.api.latency:
+            yield gen.sleep(self.api.latency)
+        result = self.api.call(method, self.get_params())
+        if result is None:
+            self.set_status(404)
+            self.write({'ok': False, 'error_code': 404,
+                        'description': 'Not Found: method not found'})
+        else:
+            self.write({'ok': True, 'result': result})
+
+    post = get
+
+
+def make_app(api, **settings):
+    return tornado.web.Application([
+        (r'/bot(?P<token>[^/]+)/(?P<method>\w+)', FakeBotApiHandler,
+         dict(api=api)),
+    ], **settings)
+
+
+if __name__ == '__main__':
+    define('port', type=int, default=8081, help='run on the given port')
+    define('latency', type=float, default=0, help='response delay in ms')
+    parse_command_line()
+    make_app(FakeBotApi(options.latency / 1000),
+             compress_response=True).listen(options.port, '127.0.0.1')
+    IOLoop.current().start()
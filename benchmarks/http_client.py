@@ -0,0 +1,81 @@
+"""Bot API HTTP client load test.
+
+Sends ``sendMessage`` requests through ``BotApiClient`` to the fake API
+server (``fakeapi.py``), running in a separate process and answering after
+``--latency`` milliseconds, and reports requests per second for several
+client settings.
+
+    python benchmarks/http_client.py --requests=5000 --latency=50
+"""
+
+import os.path
+import subprocess
+import sys
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.options import define, options, parse_command_line
+
+from gopubbot.bot.api import BotApiClient
+
+
+define('requests', type=int, default=5000, help='requests per case')
+define('concurrency', type=int, default=500, help='concurrent requests')
+define('latency', type=int, default=50, help='server latency in ms')
+
+
+@gen.coroutine
+def measure(name, port, **kwargs):
+    try:
+        api = BotApiClient('token',
+                           api_server='http://127.0.0.1:{}'.format(port),
+                           **kwargs)
+    except ImportError as e:
+        print('{:<32} skipped: {}'.format(name, e))
+        return
+    yield api.send_message(1, 'warm up')
+    remaining = [options.requests]
+
+    @gen.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            yield api.send_message(1, 'Pub at 20:00')
+
+    start = time.perf_counter()
+    yield [worker() for i in range(options.concurrency)]
+    elapsed = time.perf_counter() - start
+    api.close()
+    print('{:<32} {:>8.0f} requests/s'.format(name,
+                                               options.requests / elapsed))
+
+
+@gen.coroutine
+def main():
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    for sock in sockets:
+        sock.close()
+    server = subprocess.Popen([
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeapi.py'),
+        '--port={}'.format(port), '--latency={}'.format(options.latency),
+        '--logging=warning',
+    ])
+    try:
+        yield gen.sleep(1)
+        yield measure('simple, max_clients=10', port, max_clients=10,
+                      decompress_response=False)
+        yield measure('simple, max_clients=100', port, max_clients=100)
+        yield measure('simple, max_clients=500', port, max_clients=500)
+        yield measure('curl, max_clients=100', port, http_client='curl',
+                      max_clients=100)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    parse_command_line()
+    IOLoop.current().run_sync(main)
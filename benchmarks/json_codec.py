@@ -0,0 +1,93 @@
+"""JSON codec benchmark.
+
+Measures decoding webhook updates and Bot API replies and encoding
+keyboards and inline query results for every installed JSON backend.
+
+    python benchmarks/json_codec.py --iterations=20000
+"""
+
+import time
+
+from tornado.options import define, options, parse_command_line
+
+from gopubbot.handlers import get_event_keyboard
+from gopubbot.utils.codec import BACKENDS, get_codec
+
+
+define('iterations', type=int, default=20000, help='iterations per case')
+
+
+USER = {
+    'id': 123456789, 'first_name': 'Иван', 'last_name': 'Петров',
+    'username': 'ivanpetrov',
+}
+CHAT = dict(USER, type='private')
+MESSAGE = {
+    'message_id': 1001, 'from': USER, 'chat': CHAT, 'date': 1477000000,
+    'text': '/go Паб в 20:00',
+    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 3}],
+}
+CALLBACK_QUERY_UPDATE = {
+    'update_id': 100000001,
+    'callback_query': {
+        'id': '4382bfdwdsb323b2d9', 'from': USER, 'message': MESSAGE,
+        'chat_instance': '-4382bfdwdsb323b2d9', 'data': 'event_add:1',
+    },
+}
+SEND_MESSAGE_REPLY = {
+    'ok': True,
+    'result': dict(MESSAGE, reply_markup={
+        'inline_keyboard': get_event_keyboard(1, True),
+    }),
+}
+INLINE_RESULTS = [
+    {
+        'type': 'article', 'id': str(event_id),
+        'title': 'Паб в 20:00',
+        'input_message_content': {
+            'message_text': '\U0001F37A <b>Паб в 20:00</b>\n'
+                            '<i>(id: {})</i>\n\n'.format(event_id) +
+                            'Идут (3):\n@ivanpetrov, Петр, Анна\n',
+            'parse_mode': 'HTML',
+        },
+        'reply_markup': {'inline_keyboard': get_event_keyboard(event_id)},
+    }
+    for event_id in range(1, 21)
+]
+
+
+def measure(name, func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    print('  {:<28} {:>8.2f} us'.format(name, elapsed / iterations * 1e6))
+
+
+def run(codec):
+    update = codec.dumps(CALLBACK_QUERY_UPDATE).encode('utf-8')
+    reply = codec.dumps(SEND_MESSAGE_REPLY).encode('utf-8')
+    keyboard = {'inline_keyboard': get_event_keyboard(1, True)}
+    iterations = options.iterations
+
+    print(codec.name)
+    measure('decode update', lambda: codec.loads(update), iterations)
+    measure('decode API reply', lambda: codec.loads(reply), iterations)
+    measure('encode keyboard', lambda: codec.dumps(keyboard), iterations)
+    measure('encode inline results', lambda: codec.dumps(INLINE_RESULTS),
+            iterations)
+
+
+def main():
+    parse_command_line()
+    for name in BACKENDS:
+        try:
+            codec = get_codec(name)
+        except ImportError as e:
+            print('{} skipped: {}'.format(name, e))
+            continue
+        run(codec)
+
+
+if __name__ == '__main__':
+    main()
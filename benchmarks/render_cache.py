@@ -0,0 +1,98 @@
+"""Rendered event cache benchmark.
+
+Measures the cost of producing event message text for an inline query on an
+in-process cache hit, a Redis cache hit and a miss. Requires a local Redis
+server; the benchmark uses (and flushes) the given database.
+
+    python benchmarks/render_cache.py --participants=300 --redis_db=15
+"""
+
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+from gopubbot.handlers import EventUpdateHandler, rendered_events
+from gopubbot.storage.redis import RedisStorage
+
+
+define('participants', type=int, default=300, help='event participants')
+define('iterations', type=int, default=2000, help='iterations per case')
+define('redis_host', type=str, default='localhost', help='Redis server host')
+define('redis_port', type=int, default=6379, help='Redis server port')
+define('redis_db', type=int, default=15, help='Redis database to flush')
+
+
+class BenchmarkHandler(EventUpdateHandler):
+
+    @gen.coroutine
+    def render(self, event_id):
+        cached = self.get_cached_event(event_id)
+        event = yield self.events.get(event_id, cached and cached[0])
+        return self.render_event(event, cached)
+
+
+@gen.coroutine
+def populate(handler, participants):
+    yield handler.storage.execute('FLUSHDB')
+    user = {'id': 0, 'first_name': 'Author'}
+    yield handler.events.start(user['id'])
+    event = yield handler.events.create(user, 'Benchmark pub at 20:00')
+    for user_id in range(1, participants):
+        user = {'id': user_id, 'first_name': 'User',
+                'last_name': str(user_id)}
+        if user_id % 2:
+            user['username'] = 'user{}'.format(user_id)
+        yield handler.events.join(event.id, user)
+    return event.id
+
+
+@gen.coroutine
+def measure(name, handler, event_id, iterations, before=None):
+    elapsed = 0
+    for i in range(iterations):
+        if before is not None:
+            yield before()
+        start = time.perf_counter()
+        yield handler.render(event_id)
+        elapsed += time.perf_counter() - start
+    print('{:<16} {:>10.1f} us/op'.format(name, elapsed / iterations * 1e6))
+
+
+@gen.coroutine
+def main():
+    parse_command_line()
+    storage = RedisStorage(options.redis_host, options.redis_port,
+                           options.redis_db)
+    handler = BenchmarkHandler(None, storage)
+    event_id = yield populate(handler, options.participants)
+    rendered_key = 'event:{}:rendered'.format(event_id)
+
+    @gen.coroutine
+    def miss():
+        rendered_events.clear()
+        yield storage.delete(rendered_key)
+
+    @gen.coroutine
+    def storage_hit():
+        rendered_events.clear()
+
+    handler.cache_rendered_events = False
+    yield measure('miss', handler, event_id, options.iterations, miss)
+    handler.cache_rendered_events = True
+    yield handler.render(event_id)
+    yield gen.sleep(0.1)
+    yield measure('redis hit', handler, event_id, options.iterations,
+                  storage_hit)
+    yield measure('in-process hit', handler, event_id, options.iterations)
+    print('participants: {}, rendered text: {} bytes'.format(
+        options.participants,
+        len(rendered_events.get(event_id)[1].encode('utf-8'))
+    ))
+    yield storage.execute('FLUSHDB')
+    storage.close()
+
+
+if __name__ == '__main__':
+    IOLoop.current().run_sync(main)
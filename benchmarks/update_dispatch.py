@@ -0,0 +1,116 @@
+"""Update parsing and dispatch benchmark.
+
+Measures the cost of building update objects and of dispatching them to
+no-op handlers that read the attributes handlers usually need.
+
+    python benchmarks/update_dispatch.py --iterations=100000
+"""
+
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+from gopubbot.bot.update import (
+    UpdateDispatcher, UpdateHandler, UpdateHandlerSpec, MessageUpdate,
+    BotCommandUpdate, InlineQueryUpdate, CallbackQueryUpdate,
+)
+
+
+define('iterations', type=int, default=100000, help='iterations per case')
+
+
+USER = {
+    'id': 123456789, 'first_name': 'Ivan', 'last_name': 'Petrov',
+    'username': 'ivanpetrov',
+}
+CHAT = {
+    'id': 123456789, 'first_name': 'Ivan', 'last_name': 'Petrov',
+    'username': 'ivanpetrov', 'type': 'private',
+}
+MESSAGE = {
+    'update_id': 100000001,
+    'message': {
+        'message_id': 1001, 'from': USER, 'chat': CHAT, 'date': 1477000000,
+        'text': 'Pub at 20:00',
+    },
+}
+BOT_COMMAND = {
+    'update_id': 100000002,
+    'message': {
+        'message_id': 1002, 'from': USER, 'chat': CHAT, 'date': 1477000000,
+        'text': '/go', 'entities': [
+            {'type': 'bot_command', 'offset': 0, 'length': 3},
+        ],
+    },
+}
+INLINE_QUERY = {
+    'update_id': 100000003,
+    'inline_query': {
+        'id': '4242424242', 'from': USER, 'query': '42', 'offset': '',
+    },
+}
+CALLBACK_QUERY = {
+    'update_id': 100000004,
+    'callback_query': {
+        'id': '4343434343', 'from': USER, 'data': 'event_add:42',
+        'message': MESSAGE['message'],
+    },
+}
+
+CASES = [
+    ('message', MessageUpdate, MESSAGE),
+    ('bot_command', BotCommandUpdate, BOT_COMMAND),
+    ('inline_query', InlineQueryUpdate, INLINE_QUERY),
+    ('callback_query', CallbackQueryUpdate, CALLBACK_QUERY),
+]
+
+
+class NoopHandler(UpdateHandler):
+
+    @gen.coroutine
+    def handle(self, update):
+        update.from_user
+        if update.update_type in ('message', 'bot_command'):
+            update.chat
+            update.text
+
+
+def make_update(update_class, data):
+    if update_class is BotCommandUpdate:
+        return update_class(data, data['message']['entities'][0])
+    return update_class(data)
+
+
+@gen.coroutine
+def main():
+    parse_command_line()
+    handlers = {}
+    for update_type in ('message', 'bot_command', 'inline_query',
+                        'chosen_inline_result', 'callback_query',
+                        'edited_message'):
+        spec = UpdateHandlerSpec(NoopHandler)
+        spec.init_handler(None, None)
+        handlers[update_type] = [spec]
+    dispatcher = UpdateDispatcher(handlers)
+
+    for name, update_class, data in CASES:
+        start = time.perf_counter()
+        for i in range(options.iterations):
+            make_update(update_class, data)
+        parse = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(options.iterations):
+            yield dispatcher.dispatch(data)
+        dispatch = time.perf_counter() - start
+
+        print('{:<16} parse {:>6.2f} us   dispatch {:>6.2f} us'.format(
+            name, parse / options.iterations * 1e6,
+            dispatch / options.iterations * 1e6,
+        ))
+
+
+if __name__ == '__main__':
+    IOLoop.current().run_sync(main)
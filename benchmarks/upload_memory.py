@@ -0,0 +1,111 @@
+"""File upload memory benchmark.
+
+Uploads files of growing size with ``BotApiClient.send_document`` to a
+local server that discards request bodies, and reports the peak RSS of
+the uploading process for the streaming producer and for the in-memory
+``encode_multipart_formdata`` body. Every upload runs in a fresh process.
+
+    python benchmarks/upload_memory.py --sizes=1,16,64,256
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+import tornado.web
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.httpserver import HTTPServer
+from tornado.options import define, options, parse_command_line
+
+from gopubbot.bot.api import BotApiClient
+from gopubbot.utils.multipart import encode_multipart_formdata
+
+
+define('sizes', type=int, multiple=True, default=[1, 16, 64, 256],
+       help='file sizes in megabytes')
+define('client', type=str, help='run the upload client: streaming or memory')
+define('port', type=int, help='server port for the client')
+define('file', type=str, help='file to upload for the client')
+
+
+@tornado.web.stream_request_body
+class DiscardHandler(tornado.web.RequestHandler):
+
+    def data_received(self, chunk):
+        pass
+
+    def post(self, method):
+        self.write({'ok': True, 'result': {}})
+
+
+class InMemoryBotApiClient(BotApiClient):
+    """Client building the whole multipart body in memory."""
+
+    @gen.coroutine
+    def send(self, method, params=None, files=None, request_timeout=None):
+        body, content_type = encode_multipart_formdata(params, files)
+        request = HTTPRequest(self.api_url.format(method=method),
+                              method='POST', body=body,
+                              headers={'Content-Type': content_type},
+                              request_timeout=request_timeout)
+        response = yield self.http_client.fetch(request, raise_error=False)
+        return self.parse_response(response)
+
+
+def get_max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+@gen.coroutine
+def upload():
+    api_class = BotApiClient
+    if options.client == 'memory':
+        api_class = InMemoryBotApiClient
+    api = api_class('token',
+                    api_server='http://127.0.0.1:{}'.format(options.port))
+    yield api.send_document(1, options.file)
+    print(get_max_rss())
+
+
+@gen.coroutine
+def run_client(client, port, path):
+    args = [sys.executable, __file__, '--client=' + client,
+            '--port={}'.format(port), '--file=' + path]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    while process.poll() is None:
+        yield gen.sleep(0.05)
+    return int(process.stdout.read())
+
+
+@gen.coroutine
+def main():
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = HTTPServer(tornado.web.Application([
+        (r'/bottoken/(\w+)', DiscardHandler),
+    ]), max_body_size=1024 ** 3)
+    server.add_sockets(sockets)
+
+    print('{:>8} {:>14} {:>14}'.format('size', 'streaming', 'in memory'))
+    for size in options.sizes:
+        with tempfile.NamedTemporaryFile(suffix='.bin') as f:
+            chunk = os.urandom(1024 * 1024)
+            for i in range(size):
+                f.write(chunk)
+            f.flush()
+            streaming = yield run_client('streaming', port, f.name)
+            memory = yield run_client('memory', port, f.name)
+        print('{:>5} MB {:>11} MB {:>11} MB'.format(size, streaming, memory))
+
+
+if __name__ == '__main__':
+    parse_command_line()
+    if options.client:
+        IOLoop.current().run_sync(upload)
+    else:
+        IOLoop.current().run_sync(main)
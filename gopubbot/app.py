@@ -1,23 +1,117 @@
+import logging
 import os.path
 
+import tornado.ioloop
 import tornado.options
 from tornado.options import define, options
 
 from .bot.app import BotApp
+from .bot.ratelimit import RequestScheduler
+from .storage.redis import RedisStorage
+from .broadcast import Broadcaster
+from .events import EventRepository, EventSweeper
 from .handlers import (
     EventBotCommandHandler, EventMessageHandler, EventInlineQueryHandler,
-    EventCallbackQueryHandler
+    EventCallbackQueryHandler, EventChosenInlineResultHandler
 )
 
 
 define('debug', type=bool, default=False, help='debug mode')
+define('mode', type=str, default='webhook',
+       help='updates mode: webhook, polling or journal')
+define('poll_limit', type=int, default=100,
+       help='maximum number of updates received per poll')
+define('poll_timeout', type=int, default=30, help='long polling timeout')
 define('port', type=int, default=8000, help='run on the given port')
+define('processes', type=int, default=1,
+       help='number of webhook worker processes, 0 for one per CPU')
 define('public_port', type=int, default=443, help='public server port')
 define('public_server_name', type=str, help='public server name')
 define('use_ssl', type=bool, default=False, help='use SSL')
 define('ssl_certfile', type=str, help='path to SSL certificate file')
 define('ssl_keyfile', type=str, help='path to SSL private key file')
 define('bot_api_token', type=str, help='Telegram bot API token')
+define('redis_host', type=str, default='localhost', help='Redis server host')
+define('redis_port', type=int, default=6379, help='Redis server port')
+define('redis_db', type=int, default=0, help='Redis database number')
+define('redis_password', type=str, help='Redis server password')
+define('redis_max_connections', type=int, default=4,
+       help='maximum number of pipelined Redis connections')
+define('api_server', type=str, default='https://api.telegram.org',
+       help='Bot API server URL')
+define('api_http_client', type=str, default='simple',
+       help='Bot API HTTP client: simple or curl')
+define('api_max_clients', type=int, default=100,
+       help='maximum concurrent Bot API requests')
+define('api_connect_timeout', type=float, default=10,
+       help='Bot API connect timeout in seconds')
+define('api_request_timeout', type=float, default=30,
+       help='Bot API request timeout in seconds')
+define('api_gzip', type=bool, default=True,
+       help='accept gzip compressed Bot API responses')
+define('api_rate', type=float, default=30,
+       help='maximum Bot API requests per second, shared by the worker '
+            'processes of this host')
+define('api_chat_rate', type=float, default=1,
+       help='maximum messages per second to the same chat')
+define('api_group_rate', type=float, default=20 / 60,
+       help='maximum messages per second to the same group')
+define('api_max_retries', type=int, default=3,
+       help='maximum retries of throttled Bot API requests')
+define('dispatch_workers', type=int, default=16,
+       help='number of concurrently dispatched updates')
+define('dispatch_queue_size', type=int, default=1000,
+       help='maximum number of queued updates')
+define('overload', type=str, default='reject',
+       help='full dispatch queue policy: shed or reject updates')
+define('file_cache_size', type=int, default=1024,
+       help='number of uploaded file ids cached in process')
+define('edit_delay', type=float, default=1.0,
+       help='seconds to collect event message edits before sending')
+define('metrics', type=bool, default=False,
+       help='serve Prometheus metrics on /metrics')
+define('log_format', type=str, default='text',
+       help='updates and API responses log format: text or json')
+define('log_sample_rate', type=float, default=0.0,
+       help='share of updates logged with full payloads in json format')
+define('log_queue', type=bool, default=False,
+       help='write log records from a background thread')
+define('inline_cache_time', type=int, default=5,
+       help='seconds Telegram may cache inline query results')
+define('inline_answer_ttl', type=float, default=1.0,
+       help='seconds to reuse inline query results without reading events')
+define('event_ttl', type=int, default=30 * 24 * 60 * 60,
+       help='seconds to keep events after their last change')
+define('state_ttl', type=int, default=60 * 60,
+       help='seconds to wait for the event text after /go')
+define('sweep_interval', type=float, default=60 * 60,
+       help='seconds between stale keys sweeps')
+define('sweep_batch_size', type=int, default=100,
+       help='keys scanned per sweep batch')
+define('webhook_reply_timeout', type=float, default=0.5,
+       help='seconds to wait for a Bot API call to send in the webhook '
+            'response, 0 to disable')
+define('dedup_window', type=int, default=10000,
+       help='number of recent update ids remembered to drop redeliveries, '
+            '0 to disable')
+define('dedup_shared', type=bool, default=False,
+       help='also drop updates already dispatched by other processes')
+define('dedup_ttl', type=int, default=24 * 60 * 60,
+       help='seconds to keep shared update ids')
+define('journal', type=bool, default=False,
+       help='append webhook updates to a Redis stream journal and consume '
+            'it')
+define('journal_stream', type=str, default='bot:updates',
+       help='updates journal Redis stream key')
+define('journal_max_len', type=int, default=100000,
+       help='approximate maximum number of journal entries kept')
+define('journal_claim_idle', type=float, default=60,
+       help='seconds before entries of other consumers are claimed')
+define('broadcast_workers', type=int, default=16,
+       help='concurrent requests of a broadcast to event participants')
+define('broadcast_event', type=int,
+       help='queue a broadcast to participants of the given event and exit')
+define('broadcast_text', type=str, help='text of the queued broadcast')
 define('config', type=str, default='/etc/gopubbot/config.py',
        help='tornado config file')
 
@@ -27,24 +121,114 @@ if os.path.isfile(options.config):
     tornado.options.parse_config_file(options.config)
 
 
+def get_storage():
+    return RedisStorage(
+        host=options.redis_host,
+        port=options.redis_port,
+        db=options.redis_db,
+        password=options.redis_password,
+        max_connections=options.redis_max_connections,
+    )
+
+
+def broadcast():
+    """Queue a broadcast, sent by the running bot, to event participants."""
+    if not options.broadcast_text:
+        raise SystemExit('--broadcast_text is required')
+    broadcaster = Broadcaster(None, get_storage())
+    job_id = tornado.ioloop.IOLoop.current().run_sync(
+        lambda: broadcaster.create(options.broadcast_event,
+                                   options.broadcast_text)
+    )
+    logging.info('Broadcast %s queued', job_id)
+
+
 def run():
-    """Start bot server."""
-    BotApp(
+    """Start bot server, or queue a broadcast with ``--broadcast_event``."""
+    if options.broadcast_event is not None:
+        broadcast()
+        return
+    storage = get_storage()
+    events = EventRepository(storage, event_ttl=options.event_ttl,
+                             state_ttl=options.state_ttl)
+    sweeper = EventSweeper(storage, event_ttl=options.event_ttl,
+                           state_ttl=options.state_ttl,
+                           interval=options.sweep_interval,
+                           batch_size=options.sweep_batch_size)
+    app = BotApp(
         {
-            'bot_command': [('/go', EventBotCommandHandler)],
-            'message': [EventMessageHandler],
-            'inline_query': [EventInlineQueryHandler],
-            'callback_query': [EventCallbackQueryHandler]
+            'bot_command': [
+                ('/go', EventBotCommandHandler, dict(events=events)),
+            ],
+            'message': [
+                (None, EventMessageHandler, dict(events=events)),
+            ],
+            'inline_query': [
+                (None, EventInlineQueryHandler,
+                 dict(events=events, cache_time=options.inline_cache_time,
+                      answer_ttl=options.inline_answer_ttl)),
+            ],
+            'chosen_inline_result': [
+                (None, EventChosenInlineResultHandler, dict(events=events)),
+            ],
+            'callback_query': [
+                (['event_add', 'event_del'], EventCallbackQueryHandler,
+                 dict(events=events, edit_delay=options.edit_delay)),
+            ],
         },
         token=options.bot_api_token,
         public_server_name=options.public_server_name,
+        storage=storage,
+        scheduler=RequestScheduler(
+            rate=options.api_rate,
+            chat_rate=options.api_chat_rate,
+            group_rate=options.api_group_rate,
+            max_retries=options.api_max_retries,
+        ),
         public_port=options.public_port,
         port=options.port,
         use_ssl=options.use_ssl,
         ssl_certfile=options.ssl_certfile,
         ssl_keyfile=options.ssl_keyfile,
+        mode=options.mode,
+        poll_limit=options.poll_limit,
+        poll_timeout=options.poll_timeout,
+        dispatch_workers=options.dispatch_workers,
+        dispatch_queue_size=options.dispatch_queue_size,
+        overload=options.overload,
+        processes=options.processes,
+        file_cache_size=options.file_cache_size,
+        api_options=dict(
+            api_server=options.api_server,
+            http_client=options.api_http_client,
+            max_clients=options.api_max_clients,
+            connect_timeout=options.api_connect_timeout,
+            request_timeout=options.api_request_timeout,
+            decompress_response=options.api_gzip,
+        ),
+        metrics=options.metrics,
+        log_format=options.log_format,
+        log_sample_rate=options.log_sample_rate,
+        log_queue=options.log_queue,
+        tasks=[sweeper.run],
+        webhook_reply_timeout=options.webhook_reply_timeout,
+        dedup_window=options.dedup_window,
+        dedup_shared=options.dedup_shared,
+        dedup_ttl=options.dedup_ttl,
+        journal=options.journal,
+        journal_options=dict(
+            stream=options.journal_stream,
+            max_len=options.journal_max_len,
+        ),
+        consumer_options=dict(
+            claim_idle=options.journal_claim_idle,
+        ),
         debug=options.debug,
-    ).start()
+    )
+    broadcaster = Broadcaster(app.api, storage,
+                              workers=options.broadcast_workers)
+    app.tasks.append(broadcaster.resume)
+    app.start()
 
 if __name__ == '__main__':
     run()
@@ -1,55 +1,193 @@
-import logging
+import functools
+import time
 import urllib.parse
 
-import simplejson as json
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
 from tornado.httputil import HTTPHeaders
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 
-from ..utils.multipart import encode_multipart_formdata
+from ..utils import codec
+from ..utils.metrics import registry
+from ..utils.multipart import MultipartProducer
 from .exceptions import BotApiError
+from .files import get_result_file_id, is_file_id_error
+from .logs import PayloadLog
+from .ratelimit import UNLIMITED_METHODS
+
+
+api_request_seconds = registry.histogram(
+    'gopubbot_api_request_seconds', 'Bot API request time in seconds.',
+    ('method',),
+)
+api_errors = registry.counter(
+    'gopubbot_api_errors_total', 'Failed Bot API requests.',
+    ('method', 'error_code'),
+)
 
 
 class BotApiClient(object):
-    """Telegram Bot API client."""
+    """Telegram Bot API client.
+
+    ``http_client`` selects the HTTP client backend: ``simple`` is tornado's
+    own client, which opens a connection per request, ``curl`` uses
+    libcurl (requires pycurl) and keeps connections to the API server
+    alive. File uploads are streamed, which only the simple client
+    supports, so they always use it. Responses are logged to ``log``.
 
-    def __init__(self, token):
-        self._http_client = AsyncHTTPClient(force_instance=True)
-        self.api_url = 'https://api.telegram.org/bot{token}/{{method}}'.format(
-            token=token
+    Methods taking ``reply`` send the call in the webhook response if the
+    ``WebhookReply`` takes it, returning None instead of the result.
+    """
+
+    def __init__(self, token, scheduler=None, file_cache=None, log=None,
+                 api_server='https://api.telegram.org',
+                 http_client='simple', max_clients=100, connect_timeout=10,
+                 request_timeout=30, decompress_response=True):
+        if http_client == 'curl':
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            self._http_client_class = CurlAsyncHTTPClient
+        elif http_client == 'simple':
+            self._http_client_class = SimpleAsyncHTTPClient
+        else:
+            raise ValueError('Unknown HTTP client: {}'.format(http_client))
+        self._http_client = None
+        self._upload_client = None
+        self.max_clients = max_clients
+        self.http_defaults = {
+            'connect_timeout': connect_timeout,
+            'request_timeout': request_timeout,
+            'decompress_response': decompress_response,
+        }
+        self.scheduler = scheduler
+        self.file_cache = file_cache
+        self.log = log or PayloadLog()
+        self.api_url = '{server}/bot{token}/{{method}}'.format(
+            server=api_server.rstrip('/'), token=token
         )
 
-    def parse_response(self, response):
-        data = json.loads(response.body)
-        logging.debug(data)
+    def _make_http_client(self, cls):
+        return cls(force_instance=True, max_clients=self.max_clients,
+                   defaults=self.http_defaults)
+
+    # HTTP clients are created on first use, so that they are bound to the
+    # running IOLoop.
+
+    @property
+    def http_client(self):
+        if self._http_client is None:
+            self._http_client = self._make_http_client(
+                self._http_client_class
+            )
+        return self._http_client
+
+    @property
+    def upload_client(self):
+        if self._http_client_class is SimpleAsyncHTTPClient:
+            return self.http_client
+        if self._upload_client is None:
+            self._upload_client = self._make_http_client(
+                SimpleAsyncHTTPClient
+            )
+        return self._upload_client
+
+    def close(self):
+        for client in (self._http_client, self._upload_client):
+            if client is not None:
+                client.close()
+        self._http_client = None
+        self._upload_client = None
+
+    def parse_response(self, response, method=None):
+        try:
+            data = codec.loads(response.body)
+        except (TypeError, ValueError):
+            response.rethrow()
+            raise
+        self.log.api_response(method, data)
         if not data['ok']:
-            raise BotApiError(data['description'])
+            raise BotApiError(data['description'], data.get('error_code'),
+                              data.get('parameters'))
         return data['result']
 
+    def fetch(self, method, params=None, files=None, request_timeout=None,
+              reply=None, priority=None):
+        """Call Bot API method.
+
+        Requests go through the scheduler, if any, unless the method is not
+        subject to rate limits; ``priority`` overrides the scheduling
+        priority of the method. Calls offered to the webhook ``reply`` are
+        scheduled too, so they count towards the limits.
+        """
+        if self.scheduler is None or method in UNLIMITED_METHODS:
+            return self.send(method, params, files, request_timeout, reply)
+        return self.scheduler.schedule(
+            method, params,
+            functools.partial(self.send, method, params, files,
+                              request_timeout, reply),
+            priority
+        )
+
     @gen.coroutine
-    def fetch(self, method, params=None, files=None):
+    def send(self, method, params=None, files=None, request_timeout=None,
+             reply=None):
+        if (reply is not None and files is None and
+                reply.offer(method, params)):
+            return None
         url = self.api_url.format(method=method)
         http_method = 'GET'
         headers = HTTPHeaders()
         body = None
+        body_producer = None
+        http_client = self.http_client
 
         if files is not None:
+            http_client = self.upload_client
             http_method = 'POST'
-            body, content_type = encode_multipart_formdata(params, files)
-            headers.add('Content-Type', content_type)
+            body_producer = MultipartProducer(params, files)
+            headers.update(body_producer.headers)
         elif params is not None:
             http_method = 'POST'
             body = urllib.parse.urlencode(params)
 
         request = HTTPRequest(url, method=http_method,
-                              headers=headers, body=body)
-        response = yield self._http_client.fetch(request)
-        return self.parse_response(response)
+                              headers=headers, body=body,
+                              body_producer=body_producer,
+                              request_timeout=request_timeout)
+        start = time.perf_counter()
+        response = yield http_client.fetch(request, raise_error=False)
+        api_request_seconds.labels(method).observe(
+            time.perf_counter() - start
+        )
+        try:
+            return self.parse_response(response, method)
+        except BotApiError as e:
+            api_errors.labels(method, e.error_code or response.code).inc()
+            raise
+        except Exception:
+            api_errors.labels(method, response.code).inc()
+            raise
 
     @gen.coroutine
     def get_me(self):
         return (yield self.fetch('getMe'))
 
+    @gen.coroutine
+    def get_updates(self, offset=None, limit=None, timeout=None,
+                    allowed_updates=None):
+        params = {}
+        request_timeout = None
+        if offset is not None:
+            params['offset'] = offset
+        if limit is not None:
+            params['limit'] = limit
+        if timeout is not None:
+            params['timeout'] = timeout
+            request_timeout = timeout + 10
+        if allowed_updates is not None:
+            params['allowed_updates'] = codec.dumps(allowed_updates)
+        return (yield self.fetch('getUpdates', params,
+                                 request_timeout=request_timeout))
+
     @gen.coroutine
     def set_webhook(self, url, certificate=None):
         files = None
@@ -60,7 +198,8 @@ class BotApiClient(object):
     @gen.coroutine
     def send_message(self, chat_id, text, parse_mode=None,
                      disable_web_page_preview=None, disable_notification=None,
-                     reply_to_message_id=None, reply_markup=None):
+                     reply_to_message_id=None, reply_markup=None, reply=None,
+                     priority=None):
         params = {
             'chat_id': chat_id,
             'text': text,
@@ -74,8 +213,58 @@ class BotApiClient(object):
         if reply_to_message_id is not None:
             params['reply_to_message_id'] = reply_to_message_id
         if reply_markup is not None:
-            params['reply_markup'] = json.dumps(reply_markup)
-        return (yield self.fetch('sendMessage', params))
+            params['reply_markup'] = codec.dumps(reply_markup)
+        return (yield self.fetch('sendMessage', params, reply=reply,
+                                 priority=priority))
+
+    @gen.coroutine
+    def send_file(self, method, field, chat_id, file_path, caption=None,
+                  disable_notification=None, reply_to_message_id=None,
+                  reply_markup=None):
+        """Upload a file and send it to the chat.
+
+        With a file cache, files uploaded before are sent by their file id.
+        """
+        params = {
+            'chat_id': chat_id,
+        }
+        if caption is not None:
+            params['caption'] = caption
+        if disable_notification is not None:
+            params['disable_notification'] = disable_notification
+        if reply_to_message_id is not None:
+            params['reply_to_message_id'] = reply_to_message_id
+        if reply_markup is not None:
+            params['reply_markup'] = codec.dumps(reply_markup)
+
+        if self.file_cache is None:
+            return (yield self.fetch(method, params, {field: file_path}))
+
+        file_hash = yield self.file_cache.get_hash(file_path)
+        file_id = yield self.file_cache.get(field, file_hash)
+        if file_id is not None:
+            try:
+                return (yield self.fetch(method, dict(params, **{
+                    field: file_id,
+                })))
+            except BotApiError as e:
+                if not is_file_id_error(e):
+                    raise
+                # File id is no longer valid, upload the file again.
+                yield self.file_cache.delete(field, file_hash)
+
+        result = yield self.fetch(method, params, {field: file_path})
+        file_id = get_result_file_id(result, field)
+        if file_id is not None:
+            yield self.file_cache.set(field, file_hash, file_id)
+        return result
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self.send_file('sendDocument', 'document', chat_id, document,
+                              **kwargs)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self.send_file('sendPhoto', 'photo', chat_id, photo, **kwargs)
 
     @gen.coroutine
     def edit_message_text(self, text, chat_id=None, message_id=None,
@@ -101,16 +290,32 @@ class BotApiClient(object):
         if disable_web_page_preview is not None:
             params['disable_web_page_preview'] = disable_web_page_preview
         if reply_markup is not None:
-            params['reply_markup'] = json.dumps(reply_markup)
+            params['reply_markup'] = codec.dumps(reply_markup)
         return (yield self.fetch('editMessageText', params))
 
+    @gen.coroutine
+    def answer_callback_query(self, callback_query_id, text=None,
+                              show_alert=None):
+        params = {
+            'callback_query_id': callback_query_id,
+        }
+        if text is not None:
+            params['text'] = text
+        if show_alert is not None:
+            params['show_alert'] = show_alert
+        return (yield self.fetch('answerCallbackQuery', params))
+
     @gen.coroutine
     def answer_inline_query(self, inline_query_id, results, cache_time=None,
                             is_personal=None, next_offset=None,
-                            switch_pm_text=None, switch_pm_parameter=None):
+                            switch_pm_text=None, switch_pm_parameter=None,
+                            reply=None):
+        """Answer inline query with results, a list or its JSON string."""
+        if not isinstance(results, str):
+            results = codec.dumps(results)
         params = {
             'inline_query_id': inline_query_id,
-            'results': json.dumps(results),
+            'results': results,
         }
         if cache_time is not None:
             params['cache_time'] = cache_time
@@ -122,4 +327,4 @@ class BotApiClient(object):
             params['switch_pm_text'] = switch_pm_text
         if switch_pm_parameter is not None:
             params['switch_pm_parameter'] = switch_pm_parameter
-        return (yield self.fetch('answerInlineQuery', params))
+        return (yield self.fetch('answerInlineQuery', params, reply=reply))
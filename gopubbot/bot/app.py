@@ -1,50 +1,200 @@
+import functools
 import logging
 import os.path
 import signal
 import ssl
 
-import simplejson as json
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
-from redis import Redis
 from tornado import gen
 
+from ..utils import codec
 from ..utils.crypto import get_random_string
+from ..utils.metrics import Counter, registry
 
 from .update import UpdateDispatcher, UpdateHandlerSpec
 from .api import BotApiClient
+from .dedup import UpdateDeduplicator
+from .exceptions import BotAppError
+from .files import FileIdCache
+from .journal import JournalConsumer, UpdateJournal
+from .logs import PayloadLog, start_queue_logging
+from .polling import UpdatePoller
+from .process import WorkerStats, fork_workers, task_id
+from .queue import DispatchQueue, QueueFull, OVERLOAD_SHED, OVERLOAD_REJECT
+from .reply import WebhookReply, can_reply
+
+
+webhook_requests = registry.counter(
+    'gopubbot_webhook_requests_total', 'Webhook requests by response status.',
+    ('status',),
+)
+webhook_replies = registry.counter(
+    'gopubbot_webhook_replies_total',
+    'Bot API calls sent in webhook responses.', ('method',),
+)
 
 
 class WebHookHandler(tornado.web.RequestHandler):
-    """Webhook updates handler."""
+    """Webhook updates handler.
 
-    def initialize(self, secret, dispatcher):
+    With ``reply_timeout`` the response to an inline query or private
+    message waits up to that many seconds for a handler to offer a Bot API
+    call to send in it; other updates are answered at once. With ``journal``
+    updates are only appended to the journal as received.
+    """
+
+    def initialize(self, secret, queue, log, reply_timeout=0, journal=None):
         self.secret = secret
-        self.dispatcher = dispatcher
+        self.queue = queue
+        self.log = log
+        self.reply_timeout = reply_timeout
+        self.journal = journal
 
     @gen.coroutine
     def post(self, key):
         self.set_status(204)
-        self.flush()
-        if key == self.secret:
-            update = json.loads(self.request.body)
-            logging.info(update)
-            yield self.dispatcher.dispatch(update)
+        if key == self.secret and self.journal is not None:
+            try:
+                yield self.journal.append(self.request.body)
+            except Exception:
+                logging.exception('Error appending update to journal')
+                self.set_status(503)
+        elif key == self.secret:
+            update = codec.loads(self.request.body)
+            self.log.update(update)
+            reply = None
+            if self.reply_timeout and can_reply(update):
+                reply = WebhookReply()
+            try:
+                self.queue.put(update, reply)
+            except QueueFull:
+                logging.warning('Dispatch queue is full, update %s %s',
+                                update.get('update_id'),
+                                'shed' if self.queue.overload == OVERLOAD_SHED
+                                else 'rejected')
+                if self.queue.overload == OVERLOAD_REJECT:
+                    self.set_status(503)
+                return
+            if reply is not None:
+                call = yield reply.wait(self.reply_timeout)
+                if call is not None:
+                    webhook_replies.labels(call['method']).inc()
+                    self.set_status(200)
+                    self.set_header('Content-Type', 'application/json')
+                    self.write(codec.dumps(call))
+
+    def on_finish(self):
+        webhook_requests.labels(self.get_status()).inc()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Metrics of the process in the Prometheus text format.
+
+    In a worker process metrics carry the ``worker`` label and are followed
+    by the ``totals`` metric, summed over all workers.
+    """
+
+    def initialize(self, totals=None):
+        self.totals = totals
+
+    def get(self):
+        self.set_header('Content-Type', registry.content_type)
+        worker = task_id()
+        if worker is None:
+            self.write(registry.render())
+            return
+        self.write(registry.render({'worker': worker}))
+        if self.totals is not None:
+            self.write(self.totals.render() + '\n')
 
 
 class BotApp(object):
-    """Bot tornado web application."""
+    """Bot tornado web application.
+
+    Updates are received either by the webhook server (``webhook`` mode) or
+    by long polling ``getUpdates`` (``polling`` mode), which needs no
+    public endpoint.
+
+    With ``journal`` the webhook server only appends updates to a Redis
+    stream journal (see ``UpdateJournal``) and every process also consumes
+    it (see ``JournalConsumer``). In ``journal`` mode, which may run on
+    other hosts, processes only consume the journal. Entries left by dead
+    consumers are claimed by live ones.
+
+    In webhook and journal modes the server may run ``processes`` worker
+    processes, sharing one listening socket in webhook mode. The parent
+    process registers the webhook before starting workers and unregisters
+    it after they exit. Each worker gets an equal share of the Bot API
+    rate limits of the ``scheduler``, so all workers together stay within
+    them.
+
+    With ``metrics`` the server also serves ``/metrics`` in the Prometheus
+    text format, in polling mode too. Each worker process keeps its own
+    metrics, so the endpoint reports the worker that accepted the request,
+    labelled with its number, along with ``gopubbot_worker_stats_total``,
+    the worker stats summed over all workers.
+
+    Updates and API responses are logged in ``log_format`` (see
+    ``PayloadLog``); with ``log_queue`` log records are written by a
+    background thread.
+
+    Updates redelivered by Telegram are dropped: ids of the last
+    ``dedup_window`` updates are remembered in process and, with
+    ``dedup_shared``, claimed in storage for ``dedup_ttl`` seconds.
+
+    ``tasks`` are coroutine functions run in the background by the first
+    worker process.
+
+    With ``webhook_reply_timeout`` handlers may send one Bot API call per
+    update in the webhook response (see ``WebhookReply``), saving an
+    outbound request if they make it within that many seconds.
+    """
+
+    stats_names = (
+        'updates_queued', 'updates_dispatched', 'updates_overloaded',
+        'api_requests_sent', 'api_requests_retried', 'api_requests_failed',
+    )
 
     def __init__(self, update_handlers, token, public_server_name,
-                 public_port=443, port=8000, use_ssl=False, ssl_certfile=None,
-                 ssl_keyfile=None, debug=False):
+                 storage, scheduler=None, public_port=443, port=8000,
+                 use_ssl=False, ssl_certfile=None, ssl_keyfile=None,
+                 mode='webhook', poll_limit=100, poll_timeout=30,
+                 dispatch_workers=16, dispatch_queue_size=1000,
+                 overload=OVERLOAD_REJECT, processes=1, file_cache_size=1024,
+                 api_options=None, metrics=False, log_format='text',
+                 log_sample_rate=0.0, log_queue=False, tasks=(),
+                 webhook_reply_timeout=0, dedup_window=10000,
+                 dedup_shared=False, dedup_ttl=24 * 60 * 60, journal=False,
+                 journal_options=None, consumer_options=None, debug=False):
+        if mode not in ('webhook', 'polling', 'journal'):
+            raise BotAppError('Unknown updates mode: {}'.format(mode))
+        if processes == 0:
+            processes = os.cpu_count() or 1
+        if processes > 1 and mode == 'polling':
+            raise BotAppError('Multiple processes require webhook or '
+                              'journal mode')
+        if journal and mode == 'polling':
+            raise BotAppError('Updates journal requires webhook mode')
         self.debug = debug
+        self.mode = mode
+        self.processes = processes
+        self.metrics = metrics
+        self.log = PayloadLog(log_format, log_sample_rate)
+        self.log_queue = log_queue
+        self.log_listener = None
+        self.tasks = list(tasks)
+        self.stats = WorkerStats(self.stats_names, processes)
         self.port = port
         self.ssl_certfile = ssl_certfile
 
-        self.api = BotApiClient(token)
-        self.redis = Redis(decode_responses=True)
+        self.storage = storage
+        self.api = BotApiClient(token, scheduler,
+                                FileIdCache(storage, file_cache_size),
+                                self.log,
+                                **(api_options or {}))
 
         self.update_handlers = {}
         for update_type, update_type_handlers in update_handlers.items():
@@ -52,19 +202,46 @@ class BotApp(object):
             for spec in update_type_handlers:
                 if not isinstance(spec, UpdateHandlerSpec):
                     spec = UpdateHandlerSpec(spec)
-                spec.init_handler(self.api, self.redis)
+                spec.init_handler(self.api, self.storage)
                 self.update_handlers[update_type].append(spec)
-        self.dispatcher = UpdateDispatcher(self.update_handlers)
+        deduplicator = None
+        if dedup_window:
+            deduplicator = UpdateDeduplicator(
+                storage if dedup_shared else None, dedup_window, dedup_ttl
+            )
+        self.dispatcher = UpdateDispatcher(self.update_handlers, deduplicator)
+        self.queue = DispatchQueue(self.dispatcher, dispatch_workers,
+                                   dispatch_queue_size, overload)
+        self.poller = UpdatePoller(self.api, self.queue, self.storage,
+                                   limit=poll_limit, timeout=poll_timeout)
+        self.journal = None
+        if journal or mode == 'journal':
+            self.journal = UpdateJournal(storage, **(journal_options or {}))
+        self.consumer_options = consumer_options or {}
+        self.consumer = None
 
         webhook_secret = get_random_string(40)
         self.webhook_url = 'https://{}:{}/webhook/{}'.format(
             public_server_name, str(public_port), webhook_secret
         )
 
-        app = tornado.web.Application([
+        handlers = [
             (r'/webhook/(?P<key>[^\/]+)', WebHookHandler,
-             dict(secret=webhook_secret, dispatcher=self.dispatcher)),
-        ], debug=self.debug)
+             dict(secret=webhook_secret, queue=self.queue, log=self.log,
+                  reply_timeout=webhook_reply_timeout, journal=self.journal)),
+        ]
+        if metrics:
+            totals = Counter(
+                'gopubbot_worker_stats_total',
+                'Worker stats summed over all worker processes.', ('stat',),
+                function=lambda: {
+                    (name,): value
+                    for name, value in self.stats.totals().items()
+                },
+            )
+            handlers.append((r'/metrics', MetricsHandler,
+                             dict(totals=totals)))
+        app = tornado.web.Application(handlers, debug=self.debug)
 
         ssl_ctx = None
         if (use_ssl and ssl_certfile and ssl_keyfile):
@@ -75,7 +252,37 @@ class BotApp(object):
                                                          ssl_options=ssl_ctx)
 
     def start(self):
-        self.http_server.listen(self.port)
+        if self.processes > 1:
+            sockets = None
+            if self.mode == 'webhook':
+                sockets = tornado.netutil.bind_sockets(self.port)
+                self.run_sync(self.register, self.webhook_url,
+                              self.ssl_certfile)
+            if fork_workers(self.processes) is None:
+                logging.info('Workers stats: %s', self.stats.totals())
+                if self.mode == 'webhook':
+                    self.run_sync(self.unregister)
+                return
+            if sockets is not None:
+                self.http_server.add_sockets(sockets)
+            if self.api.scheduler is not None:
+                self.api.scheduler.share(self.processes)
+        elif self.mode == 'webhook' or self.metrics:
+            self.http_server.listen(self.port)
+
+        if self.log_queue:
+            self.log_listener = start_queue_logging()
+        self.queue.start()
+        if self.journal is not None:
+            # Created after forking, as consumers are named by process id.
+            self.consumer = JournalConsumer(
+                self.journal, self.queue, self.storage.open_connection,
+                log=self.log, **self.consumer_options
+            )
+        if not task_id():
+            io_loop = tornado.ioloop.IOLoop.current()
+            for task in self.tasks:
+                io_loop.spawn_callback(task)
 
         def signal_handler(sig, frame):
             io_loop = tornado.ioloop.IOLoop.instance()
@@ -84,22 +291,88 @@ class BotApp(object):
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGINT, signal_handler)
 
-        self.register(self.webhook_url, self.ssl_certfile)
+        tornado.ioloop.PeriodicCallback(self.publish_stats, 1000).start()
+        if self.processes == 1:
+            if self.mode == 'webhook':
+                self.register(self.webhook_url, self.ssl_certfile)
+            elif self.mode == 'polling':
+                self.start_polling()
+        if self.consumer is not None:
+            self.start_consuming()
 
         tornado.ioloop.IOLoop.instance().start()
+        if self.log_listener is not None:
+            self.log_listener.stop()
 
     @gen.coroutine
     def stop(self):
-        self.http_server.stop()
-        yield self.unregister()
+        if self.mode == 'webhook':
+            self.http_server.stop()
+            if self.processes == 1:
+                yield self.unregister()
+        else:
+            if self.metrics:
+                self.http_server.stop()
+            self.poller.stop()
+        if self.consumer is not None:
+            self.consumer.stop()
+        self.publish_stats()
+        self.storage.close()
         tornado.ioloop.IOLoop.instance().stop()
 
+    def run_sync(self, func, *args):
+        """Run a coroutine on a temporary IOLoop.
+
+        Used by the parent process, which must not start the global IOLoop.
+        The loop is never made current, so forked workers do not inherit
+        it closed.
+        """
+        io_loop = tornado.ioloop.IOLoop(make_current=False)
+        try:
+            return io_loop.run_sync(functools.partial(func, *args))
+        finally:
+            self.api.close()
+            io_loop.close()
+
+    def get_stats(self):
+        """Return counters of the current process."""
+        stats = {
+            'updates_queued': self.queue.queued,
+            'updates_dispatched': self.queue.dispatched,
+            'updates_overloaded': self.queue.overloaded,
+        }
+        scheduler = self.api.scheduler
+        if scheduler is not None:
+            stats.update({
+                'api_requests_sent': scheduler.sent,
+                'api_requests_retried': scheduler.retried,
+                'api_requests_failed': scheduler.failed,
+            })
+        return stats
+
+    def publish_stats(self):
+        self.stats.publish(self.get_stats())
+
     @gen.coroutine
     def register(self, webhook_url, certificate=None):
         self.me = yield self.api.get_me()
+        self.dispatcher.compile(self.me.get('username'))
         result = yield self.api.set_webhook(webhook_url, certificate)
         return result
 
+    @gen.coroutine
+    def start_polling(self):
+        self.me = yield self.api.get_me()
+        self.dispatcher.compile(self.me.get('username'))
+        yield self.api.set_webhook('')
+        yield self.poller.run()
+
+    @gen.coroutine
+    def start_consuming(self):
+        self.me = yield self.api.get_me()
+        self.dispatcher.compile(self.me.get('username'))
+        yield self.consumer.run()
+
     @gen.coroutine
     def unregister(self):
         result = yield self.api.set_webhook('')
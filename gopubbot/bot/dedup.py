@@ -0,0 +1,63 @@
+import collections
+import logging
+
+from tornado import gen
+
+from ..utils.metrics import registry
+
+
+dedup_checks = registry.counter(
+    'gopubbot_dedup_checks_total',
+    'Update id checks by result: new, or duplicate found in memory or '
+    'in Redis.', ('result',),
+)
+
+
+class UpdateDeduplicator(object):
+    """Drops updates delivered more than once.
+
+    Ids of the last ``window`` updates are kept in process. With
+    ``storage`` each new id is also claimed in Redis for ``ttl`` seconds,
+    so an update redelivered to another process or node is dropped too,
+    unless checked with ``shared`` false. If Redis is unavailable, updates
+    are dispatched rather than lost.
+    """
+
+    def __init__(self, storage=None, window=10000, ttl=24 * 60 * 60,
+                 key_prefix='bot:update:'):
+        self.storage = storage
+        self.window = window
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._seen = set()
+        self._order = collections.deque()
+
+    def remember(self, update_id):
+        """Add the id to the window; return whether it was there already."""
+        if update_id in self._seen:
+            return True
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.window:
+            self._seen.discard(self._order.popleft())
+        return False
+
+    @gen.coroutine
+    def is_duplicate(self, update_id, shared=True):
+        if self.remember(update_id):
+            dedup_checks.labels('memory').inc()
+            return True
+        if self.storage is not None and shared:
+            try:
+                claimed = yield self.storage.execute(
+                    'SET', self.key_prefix + str(update_id), 1,
+                    'NX', 'EX', self.ttl
+                )
+            except Exception:
+                logging.exception('Error checking update %s', update_id)
+            else:
+                if claimed is None:
+                    dedup_checks.labels('redis').inc()
+                    return True
+        dedup_checks.labels('new').inc()
+        return False
@@ -0,0 +1,147 @@
+import logging
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from ..utils.cache import LRUCache
+from ..utils.metrics import registry
+from .exceptions import BotApiError
+
+
+message_edits = registry.counter(
+    'gopubbot_message_edits_total',
+    'Message text edits by result: scheduled, coalesced, ignored, sent or '
+    'failed.', ('result',),
+)
+
+
+class PendingEdit(object):
+    """Newest not yet sent edit of a message."""
+
+    def __init__(self):
+        self.text = None
+        self.params = None
+        self.futures = []
+        self.error_callbacks = []
+
+
+class EditScheduler(object):
+    """Coalescing message text editor.
+
+    Edits of the same message are delayed by ``delay`` seconds and merged,
+    so only the newest text is sent. At most one edit of a message is in
+    flight at a time; edits scheduled meanwhile are sent after it finishes.
+
+    Edits may carry a ``version`` of the content, e.g. when concurrent
+    handlers render it: an edit older than the newest one scheduled for
+    the message is ignored. Versions of the last ``max_versions`` edited
+    messages are remembered.
+
+    An edit rejected because the message already has the same text and
+    markup, e.g. one sent by another process, is counted as sent.
+
+    Edits are counted by result in the ``gopubbot_message_edits_total``
+    metric as well as in the scheduler attributes.
+    """
+
+    def __init__(self, api, delay=1.0, max_versions=10000):
+        self.api = api
+        self.delay = delay
+        self._pending = {}
+        self._in_flight = set()
+        self._versions = LRUCache(max_versions)
+        self.scheduled = 0
+        self.coalesced = 0
+        self.ignored = 0
+        self.sent = 0
+        self.failed = 0
+
+    def edit_message_text(self, text, chat_id=None, message_id=None,
+                          message=None, inline_message_id=None, version=None,
+                          on_error=None, **params):
+        """Schedule a message text edit.
+
+        Accepts ``BotApiClient.edit_message_text`` arguments. Returns a
+        future resolving to the API result of the edit that was actually
+        sent, or None if it failed or was ignored as older. ``on_error`` is
+        called with the exception if the edit sent fails.
+        """
+        if inline_message_id is not None:
+            key = inline_message_id
+            params['inline_message_id'] = inline_message_id
+        elif message is not None:
+            key = (message['chat']['id'], message['message_id'])
+            params['message'] = message
+        elif chat_id is not None and message_id is not None:
+            key = (chat_id, message_id)
+            params['chat_id'] = chat_id
+            params['message_id'] = message_id
+        else:
+            raise TypeError('You must specify inline_message_id, '
+                            'message object or both chat_id and message_id')
+
+        self.scheduled += 1
+        message_edits.labels('scheduled').inc()
+        future = Future()
+        if version is not None:
+            newest = self._versions.get(key)
+            if newest is not None and version < newest:
+                self.ignored += 1
+                message_edits.labels('ignored').inc()
+                future.set_result(None)
+                return future
+            self._versions.set(key, version)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = PendingEdit()
+            if key not in self._in_flight:
+                IOLoop.current().call_later(self.delay, self._flush, key)
+        else:
+            self.coalesced += 1
+            message_edits.labels('coalesced').inc()
+        pending.text = text
+        pending.params = params
+        pending.futures.append(future)
+        if on_error is not None:
+            pending.error_callbacks.append(on_error)
+        return future
+
+    @gen.coroutine
+    def _flush(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        self._in_flight.add(key)
+        try:
+            result = yield self.api.edit_message_text(pending.text,
+                                                      **pending.params)
+        except BotApiError as e:
+            if 'message is not modified' in e.description.lower():
+                logging.debug('Message %r is not modified', key)
+                self.sent += 1
+                message_edits.labels('sent').inc()
+            else:
+                self._fail(key, pending, e)
+            result = None
+        except Exception as e:
+            self._fail(key, pending, e)
+            result = None
+        else:
+            self.sent += 1
+            message_edits.labels('sent').inc()
+        finally:
+            self._in_flight.discard(key)
+        for future in pending.futures:
+            future.set_result(result)
+        if key in self._pending:
+            IOLoop.current().call_later(self.delay, self._flush, key)
+
+    def _fail(self, key, pending, error):
+        logging.error('Error editing message %r', key, exc_info=error)
+        self.failed += 1
+        message_edits.labels('failed').inc()
+        for callback in pending.error_callbacks:
+            callback(error)
+
+
@@ -8,3 +8,13 @@ class BotAppError(Exception):
 
 class BotApiError(Exception):
     """Bot API Error."""
+
+    def __init__(self, description, error_code=None, parameters=None):
+        super().__init__(description)
+        self.description = description
+        self.error_code = error_code
+        self.parameters = parameters or {}
+
+    @property
+    def retry_after(self):
+        return self.parameters.get('retry_after', None)
@@ -0,0 +1,94 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+
+from ..utils.cache import LRUCache
+
+
+def hash_file(file_path, chunk_size=64 * 1024):
+    """Return SHA-1 hex digest of the file content."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_result_file_id(result, field):
+    """Return id of the file sent as ``field`` from the sent message."""
+    file = result.get(field)
+    if isinstance(file, list):
+        # Photo sizes, the largest one is the last.
+        file = file[-1] if file else None
+    if file is None:
+        return None
+    return file.get('file_id')
+
+
+def is_file_id_error(error):
+    """Tell whether the Bot API error rejects a sent file id."""
+    if error.error_code != 400:
+        return False
+    description = (error.description or '').lower()
+    return any(s in description for s in (
+        'file identifier', 'file_id', 'file reference',
+    ))
+
+
+class FileIdCache(object):
+    """Telegram file ids of uploaded files.
+
+    Files are identified by their content hash; hashes are remembered by
+    path, modification time and size, so unchanged files are not read
+    again. File ids are persisted in storage, recently used ones are also
+    kept in process.
+    """
+
+    def __init__(self, storage, max_size=1024, key_prefix='file_id'):
+        self.storage = storage
+        self.key_prefix = key_prefix
+        self._hashes = LRUCache(max_size)
+        self._file_ids = LRUCache(max_size)
+        self._executor = ThreadPoolExecutor(1)
+
+    def get_key(self, kind, file_hash):
+        return '{}:{}:{}'.format(self.key_prefix, kind, file_hash)
+
+    @gen.coroutine
+    def get_hash(self, file_path):
+        """Return content hash of the file, hashing it off the IOLoop."""
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_mtime, stat.st_size)
+        file_hash = self._hashes.get(key)
+        if file_hash is None:
+            file_hash = yield self._executor.submit(hash_file, file_path)
+            self._hashes.set(key, file_hash)
+        return file_hash
+
+    @gen.coroutine
+    def get(self, kind, file_hash):
+        """Return id of the file of given kind or None."""
+        key = self.get_key(kind, file_hash)
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            file_id = yield self.storage.get(key)
+            if file_id is not None:
+                self._file_ids.set(key, file_id)
+        return file_id
+
+    @gen.coroutine
+    def set(self, kind, file_hash, file_id):
+        key = self.get_key(kind, file_hash)
+        self._file_ids.set(key, file_id)
+        yield self.storage.set(key, file_id)
+
+    @gen.coroutine
+    def delete(self, kind, file_hash):
+        key = self.get_key(kind, file_hash)
+        self._file_ids.pop(key)
+        yield self.storage.delete(key)
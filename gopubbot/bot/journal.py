@@ -0,0 +1,188 @@
+import functools
+import logging
+import os
+import socket
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from ..storage.exceptions import StorageReplyError
+from ..utils import codec
+from ..utils.metrics import registry
+
+
+journal_entries = registry.counter(
+    'gopubbot_journal_entries_total',
+    'Update journal entries by action: appended, acked, claimed or dropped.',
+    ('action',),
+)
+
+
+class UpdateJournal(object):
+    """Journal of received updates in a Redis stream.
+
+    Entries hold the raw update JSON in the ``update`` field and are read
+    by consumers of the ``group`` consumer group. The stream is trimmed to
+    about ``max_len`` entries, so entries not dispatched by then are lost.
+    Requires Redis 5.0.
+    """
+
+    def __init__(self, storage, stream='bot:updates', group='dispatchers',
+                 max_len=100000):
+        self.storage = storage
+        self.stream = stream
+        self.group = group
+        self.max_len = max_len
+
+    @gen.coroutine
+    def append(self, body):
+        """Append the raw update JSON to the journal."""
+        entry_id = yield self.storage.execute(
+            'XADD', self.stream, 'MAXLEN', '~', self.max_len, '*',
+            'update', body
+        )
+        journal_entries.labels('appended').inc()
+        return entry_id
+
+    @gen.coroutine
+    def create_group(self):
+        """Create the consumer group reading the journal from the start."""
+        try:
+            yield self.storage.execute('XGROUP', 'CREATE', self.stream,
+                                       self.group, '0', 'MKSTREAM')
+        except StorageReplyError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    @gen.coroutine
+    def ack(self, entry_id):
+        yield self.storage.execute('XACK', self.stream, self.group, entry_id)
+        journal_entries.labels('acked').inc()
+
+
+class JournalConsumer(object):
+    """Dispatches journal entries as a member of the consumer group.
+
+    Entries are read in batches of ``batch_size`` over a dedicated
+    connection returned by ``connect``, as reads block for up to ``block``
+    seconds, and put to the dispatch queue, waiting while it is full. A
+    closed connection is replaced by a new one. Entries are acknowledged
+    once dispatched; entries whose dispatch failed stay pending and are
+    claimed again like entries of dead consumers.
+
+    Every ``claim_interval`` seconds entries that other consumers, e.g.
+    dead ones, have left unacknowledged for ``claim_idle`` seconds are
+    claimed and dispatched as redelivered, so the shared deduplication
+    check made by their first delivery does not drop them. Entries
+    delivered ``max_deliveries`` times are acknowledged without
+    dispatching them again.
+    """
+
+    def __init__(self, journal, queue, connect, name=None, log=None,
+                 batch_size=100, block=5, claim_idle=60, claim_interval=30,
+                 max_deliveries=5, retry_delay=5):
+        self.journal = journal
+        self.queue = queue
+        self.connect = connect
+        self.connection = None
+        self.name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.log = log
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self.claim_interval = claim_interval
+        self.max_deliveries = max_deliveries
+        self.retry_delay = retry_delay
+        self._running = False
+        self._failed = set()
+
+    @gen.coroutine
+    def run(self):
+        self._running = True
+        io_loop = IOLoop.current()
+        claimed = None
+        while self._running:
+            try:
+                if claimed is None:
+                    yield self.journal.create_group()
+                if (claimed is None or
+                        io_loop.time() - claimed >= self.claim_interval):
+                    claimed = io_loop.time()
+                    yield self.claim()
+                if self.connection is None or self.connection.closed:
+                    self.connection = self.connect()
+                yield self.read()
+            except Exception:
+                logging.exception('Error consuming updates journal')
+                yield gen.sleep(self.retry_delay)
+        if self.connection is not None:
+            self.connection.close()
+
+    def stop(self):
+        self._running = False
+
+    @gen.coroutine
+    def read(self):
+        journal = self.journal
+        reply = yield self.connection.execute(
+            'XREADGROUP', 'GROUP', journal.group, self.name,
+            'COUNT', self.batch_size, 'BLOCK', int(self.block * 1000),
+            'STREAMS', journal.stream, '>'
+        )
+        if reply is None:
+            return
+        for entry_id, fields in reply[0][1]:
+            yield self.put(entry_id, fields)
+
+    @gen.coroutine
+    def claim(self):
+        journal = self.journal
+        pending = yield journal.storage.execute(
+            'XPENDING', journal.stream, journal.group, '-', '+',
+            self.batch_size
+        )
+        min_idle = int(self.claim_idle * 1000)
+        entry_ids = []
+        for entry_id, consumer, idle, deliveries in pending:
+            if idle < min_idle or (consumer == self.name and
+                                   entry_id not in self._failed):
+                continue
+            self._failed.discard(entry_id)
+            if deliveries >= self.max_deliveries:
+                logging.warning('Dropping update journal entry %s delivered '
+                                '%d times', entry_id, deliveries)
+                journal_entries.labels('dropped').inc()
+                yield journal.ack(entry_id)
+            else:
+                entry_ids.append(entry_id)
+        if not entry_ids:
+            return
+        entries = yield journal.storage.execute(
+            'XCLAIM', journal.stream, journal.group, self.name, min_idle,
+            *entry_ids
+        )
+        for entry in entries:
+            # Entries trimmed from the stream are returned as nil.
+            if entry is not None:
+                journal_entries.labels('claimed').inc()
+                yield self.put(*entry, redelivered=True)
+
+    @gen.coroutine
+    def put(self, entry_id, fields, redelivered=False):
+        if not fields:
+            yield self.journal.ack(entry_id)
+            return
+        data = dict(zip(fields[::2], fields[1::2]))
+        update = codec.loads(data['update'])
+        if self.log is not None:
+            self.log.update(update)
+        yield self.queue.put_wait(update,
+                                  callback=functools.partial(self.done,
+                                                             entry_id),
+                                  redelivered=redelivered)
+
+    def done(self, entry_id, dispatched):
+        if dispatched:
+            IOLoop.current().spawn_callback(self.journal.ack, entry_id)
+        else:
+            self._failed.add(entry_id)
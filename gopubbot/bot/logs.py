@@ -0,0 +1,93 @@
+import logging
+import logging.handlers
+import queue
+import random
+
+from ..utils import codec
+
+
+LOG_TEXT = 'text'
+LOG_JSON = 'json'
+
+UPDATE_TYPES = ('message', 'edited_message', 'inline_query',
+                'chosen_inline_result', 'callback_query')
+
+
+def get_update_summary(update):
+    """Return the update id, type and chat and user ids of the update."""
+    summary = {'update_id': update.get('update_id')}
+    for update_type in UPDATE_TYPES:
+        if update_type in update:
+            data = update[update_type]
+            summary['type'] = update_type
+            if 'chat' in data:
+                summary['chat_id'] = data['chat']['id']
+            if 'from' in data:
+                summary['user_id'] = data['from']['id']
+            break
+    return summary
+
+
+class PayloadLog(object):
+    """Log of received updates and Bot API responses.
+
+    ``text`` format logs whole payloads, updates at INFO and responses at
+    DEBUG level. ``json`` format logs one compact JSON line per update with
+    its ids and type and one per response with the method; whole payloads
+    are logged only for a ``sample_rate`` share of them. Nothing is
+    formatted unless the level is enabled.
+    """
+
+    def __init__(self, format=LOG_TEXT, sample_rate=0.0, logger=None):
+        if format not in (LOG_TEXT, LOG_JSON):
+            raise ValueError('Unknown log format: {}'.format(format))
+        self.format = format
+        self.sample_rate = sample_rate
+        self.logger = logger or logging.getLogger()
+
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def update(self, update):
+        logger = self.logger
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        if self.format == LOG_TEXT:
+            logger.info(update)
+            return
+        summary = get_update_summary(update)
+        if self.sampled():
+            summary['update'] = update
+        logger.info(codec.dumps(summary))
+
+    def api_response(self, method, data):
+        logger = self.logger
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.format == LOG_TEXT:
+            logger.debug(data)
+            return
+        summary = {'method': method, 'ok': data.get('ok')}
+        if self.sampled():
+            summary['response'] = data
+        logger.debug(codec.dumps(summary))
+
+
+def start_queue_logging(logger=None):
+    """Move the logger handlers to a background thread.
+
+    The handlers are replaced by one putting records to a queue, so the
+    IOLoop never waits for log writes. Returns the started queue listener,
+    which must be stopped to flush the queue. Must be called after forking
+    worker processes, as the listener thread does not survive a fork.
+    """
+    logger = logger or logging.getLogger()
+    records = queue.Queue()
+    listener = logging.handlers.QueueListener(
+        records, *logger.handlers, respect_handler_level=True
+    )
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    return listener
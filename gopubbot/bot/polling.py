@@ -0,0 +1,69 @@
+import logging
+
+from tornado import gen
+
+
+class UpdatePoller(object):
+    """Long polling updates receiver.
+
+    Receives updates with ``getUpdates`` and puts them to the dispatch
+    queue. The next poll is sent while the current batch is being queued;
+    the offset is persisted in storage so a restarted bot continues where
+    it stopped. Storage errors are logged and retried, so polling never
+    stops while the bot runs.
+    """
+
+    def __init__(self, api, queue, storage, limit=100, timeout=30,
+                 retry_delay=5, offset_key='bot:updates:offset'):
+        self.api = api
+        self.queue = queue
+        self.storage = storage
+        self.limit = limit
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.offset_key = offset_key
+        self._running = False
+
+    def poll(self, offset):
+        return self.api.get_updates(offset, self.limit, self.timeout)
+
+    @gen.coroutine
+    def load_offset(self):
+        """Return the persisted offset, retrying on storage errors."""
+        while True:
+            try:
+                offset = yield self.storage.get(self.offset_key)
+            except Exception:
+                logging.exception('Error loading updates offset')
+                yield gen.sleep(self.retry_delay)
+                continue
+            return int(offset) if offset is not None else None
+
+    @gen.coroutine
+    def run(self):
+        self._running = True
+        offset = yield self.load_offset()
+        future = self.poll(offset)
+        while self._running:
+            try:
+                updates = yield future
+            except Exception:
+                logging.exception('Error receiving updates')
+                yield gen.sleep(self.retry_delay)
+                future = self.poll(offset)
+                continue
+            if not updates:
+                future = self.poll(offset)
+                continue
+            offset = updates[-1]['update_id'] + 1
+            future = self.poll(offset)
+            try:
+                for update in updates:
+                    yield self.queue.put_wait(update)
+                # Saved again with the next batch if this write fails.
+                yield self.storage.set(self.offset_key, offset)
+            except Exception:
+                logging.exception('Error queueing updates')
+
+    def stop(self):
+        self._running = False
@@ -0,0 +1,114 @@
+import errno
+import logging
+import multiprocessing.sharedctypes
+import os
+import signal
+
+
+_task_id = None
+
+
+def task_id():
+    """Return the current worker number or None in a single process."""
+    return _task_id
+
+
+class WorkerStats(object):
+    """Counters shared by worker processes.
+
+    Each worker publishes its own counters into a shared memory slot, so
+    any process can read totals without locking.
+    """
+
+    def __init__(self, names, workers):
+        self.names = list(names)
+        self.workers = workers
+        self._values = multiprocessing.sharedctypes.RawArray(
+            'q', len(self.names) * workers
+        )
+
+    def publish(self, counters):
+        """Store counters of the current worker."""
+        offset = (_task_id or 0) * len(self.names)
+        for i, name in enumerate(self.names):
+            self._values[offset + i] = int(counters.get(name, 0))
+
+    def totals(self):
+        """Return counters summed over all workers."""
+        size = len(self.names)
+        return {
+            name: sum(self._values[worker * size + i]
+                      for worker in range(self.workers))
+            for i, name in enumerate(self.names)
+        }
+
+
+def fork_workers(num_workers, max_restarts=100):
+    """Start worker processes.
+
+    Returns the worker number in a child process. The parent process
+    restarts workers that die unexpectedly, forwards SIGTERM and SIGINT to
+    the workers and returns None once they all exit.
+
+    No IOLoop may be running or used before forking.
+    """
+    global _task_id
+    children = {}
+    stopping = []
+
+    def start_child(i):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return True
+        children[pid] = i
+        return False
+
+    def signal_handler(sig, frame):
+        stopping.append(sig)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+
+    for i in range(num_workers):
+        if start_child(i):
+            _task_id = i
+            return i
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        i = children.pop(pid)
+        if os.WIFSIGNALED(status):
+            logging.warning('Worker %d (pid %d) killed by signal %d',
+                            i, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning('Worker %d (pid %d) exited with status %d',
+                            i, pid, os.WEXITSTATUS(status))
+        else:
+            logging.info('Worker %d (pid %d) exited', i, pid)
+            continue
+        if stopping:
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            logging.error('Too many worker restarts, giving up')
+            signal_handler(signal.SIGTERM, None)
+            continue
+        if start_child(i):
+            _task_id = i
+            return i
+    return None
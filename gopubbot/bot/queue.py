@@ -0,0 +1,131 @@
+import collections
+import logging
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from tornado.queues import Queue, QueueFull
+
+from ..utils.metrics import registry
+
+
+OVERLOAD_SHED = 'shed'
+OVERLOAD_REJECT = 'reject'
+
+updates_pending = registry.gauge(
+    'gopubbot_updates_pending', 'Updates queued or being dispatched.',
+)
+updates_in_flight = registry.gauge(
+    'gopubbot_updates_in_flight', 'Updates being dispatched.',
+)
+
+
+def get_update_key(update):
+    """Return the chat or user the update belongs to."""
+    for update_type in ('message', 'edited_message'):
+        if update_type in update:
+            return 'chat:{}'.format(update[update_type]['chat']['id'])
+    for update_type in ('callback_query', 'inline_query',
+                        'chosen_inline_result'):
+        if update_type in update:
+            return 'user:{}'.format(update[update_type]['from']['id'])
+    return None
+
+
+class DispatchQueue(object):
+    """Bounded queue of updates dispatched by a pool of workers.
+
+    Updates from the same chat or user are dispatched one at a time in
+    arrival order; updates from different chats are dispatched in parallel
+    by up to ``workers`` coroutines. At most ``max_size`` updates are
+    queued or being dispatched; ``put`` raises ``QueueFull`` beyond that
+    and ``overload`` tells whether such updates should be shed or rejected
+    so Telegram redelivers them. Once the update is dispatched, a webhook
+    reply queued with it is closed and a callback queued with it is called
+    with whether dispatching succeeded. Updates queued as ``redelivered``
+    are dispatched as such (see ``UpdateDispatcher``).
+    """
+
+    def __init__(self, dispatcher, workers=16, max_size=1000,
+                 overload=OVERLOAD_REJECT):
+        assert overload in (OVERLOAD_SHED, OVERLOAD_REJECT)
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.max_size = max_size
+        self.overload = overload
+        self.size = 0
+        self.queued = 0
+        self.dispatched = 0
+        self.overloaded = 0
+        self._updates = {}
+        self._ready = None
+        self._not_full = None
+
+    def start(self):
+        self._ready = Queue()
+        self._not_full = Condition()
+        io_loop = IOLoop.current()
+        for i in range(self.workers):
+            io_loop.spawn_callback(self._work)
+
+    def full(self):
+        return self.size >= self.max_size
+
+    def put(self, update, reply=None, callback=None, redelivered=False):
+        """Queue the update or raise ``QueueFull``."""
+        if self.full():
+            self.overloaded += 1
+            raise QueueFull
+        self.size += 1
+        self.queued += 1
+        updates_pending.inc()
+        entry = (update, reply, callback, redelivered)
+        key = get_update_key(update)
+        if key is None:
+            self._ready.put_nowait((None, entry))
+            return
+        updates = self._updates.get(key)
+        if updates is None:
+            self._updates[key] = collections.deque([entry])
+            self._ready.put_nowait((key, None))
+        else:
+            updates.append(entry)
+
+    @gen.coroutine
+    def put_wait(self, update, callback=None, redelivered=False):
+        """Queue the update, waiting for free space if the queue is full."""
+        while self.full():
+            yield self._not_full.wait()
+        self.put(update, callback=callback, redelivered=redelivered)
+
+    @gen.coroutine
+    def _work(self):
+        while True:
+            key, entry = yield self._ready.get()
+            if key is not None:
+                updates = self._updates[key]
+                entry = updates.popleft()
+            update, reply, callback, redelivered = entry
+            updates_in_flight.inc()
+            try:
+                yield self.dispatcher.dispatch(update, reply, redelivered)
+            except Exception:
+                logging.exception('Error dispatching update %s',
+                                  update.get('update_id'))
+                dispatched = False
+            else:
+                dispatched = True
+            if reply is not None:
+                reply.close()
+            if callback is not None:
+                callback(dispatched)
+            updates_in_flight.dec()
+            updates_pending.dec()
+            self.size -= 1
+            self.dispatched += 1
+            self._not_full.notify()
+            if key is not None:
+                if updates:
+                    self._ready.put_nowait((key, None))
+                else:
+                    del self._updates[key]
@@ -0,0 +1,241 @@
+import collections
+import logging
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from .exceptions import BotApiError
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+METHOD_PRIORITIES = {
+    'answerInlineQuery': PRIORITY_HIGH,
+    'answerCallbackQuery': PRIORITY_HIGH,
+    'editMessageText': PRIORITY_LOW,
+}
+
+# Methods not subject to message limits.
+UNLIMITED_METHODS = frozenset([
+    'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'getWebhookInfo',
+    'getFile',
+])
+
+# Methods answering queries do not send messages to chats.
+CHAT_EXEMPT_METHODS = frozenset(['answerInlineQuery', 'answerCallbackQuery'])
+
+
+class TokenBucket(object):
+    """Token bucket refilled with ``rate`` tokens per second."""
+
+    def __init__(self, rate, capacity=1, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        if self.updated is None:
+            self.updated = now
+        elif now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def delay(self, now):
+        """Return seconds until a token is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        """Make no tokens available for the given number of seconds."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class Request(object):
+    """Scheduled Bot API request."""
+
+    def __init__(self, method, chat_id, priority, send):
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.send = send
+        self.attempts = 0
+        self.future = Future()
+
+    @property
+    def is_group(self):
+        return str(self.chat_id).startswith('-')
+
+
+class RequestScheduler(object):
+    """Outbound Bot API request scheduler.
+
+    Requests are sent in priority order as fast as a global token bucket,
+    a per chat bucket and, for group chats, a per group bucket allow.
+    Requests rejected with ``retry_after`` are paused and retried up to
+    ``max_retries`` times.
+
+    Limits are enforced in process only: with several worker processes
+    each one must be given its share of them (see ``share``).
+    """
+
+    def __init__(self, rate=30, chat_rate=1, group_rate=20 / 60,
+                 burst=1, chat_burst=1, group_burst=3, max_retries=3,
+                 max_idle_buckets=10000):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_idle_buckets = max_idle_buckets
+        self._bucket = TokenBucket(rate, burst)
+        self._chat_buckets = {}
+        self._group_buckets = {}
+        self._queues = [collections.deque() for i in range(PRIORITY_LOW + 1)]
+        self._timeout = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def share(self, workers):
+        """Limit the rates to one of ``workers`` equal shares.
+
+        Called in a worker before any request is scheduled.
+        """
+        self.rate /= workers
+        self.chat_rate /= workers
+        self.group_rate /= workers
+        self._bucket = TokenBucket(self.rate, self._bucket.capacity)
+        self._chat_buckets.clear()
+        self._group_buckets.clear()
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def schedule(self, method, params, send, priority=None):
+        """Schedule a request.
+
+        ``send`` is called without arguments to send the request and must
+        return a future. Returns a future resolving to its result. The
+        priority defaults to the one of the method.
+        """
+        chat_id = None
+        if params is not None and method not in CHAT_EXEMPT_METHODS:
+            chat_id = params.get('chat_id', None)
+        if priority is None:
+            priority = METHOD_PRIORITIES.get(method, PRIORITY_NORMAL)
+        request = Request(method, chat_id, priority, send)
+        self._queues[priority].append(request)
+        self._wake()
+        return request.future
+
+    def _get_buckets(self, chat_id, is_group, now):
+        buckets = []
+        if chat_id is None:
+            return buckets
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chat_buckets[chat_id] = bucket
+        buckets.append(bucket)
+        if is_group:
+            bucket = self._group_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+                self._group_buckets[chat_id] = bucket
+            buckets.append(bucket)
+        return buckets
+
+    def _prune_buckets(self, now):
+        for buckets in (self._chat_buckets, self._group_buckets):
+            if len(buckets) > self.max_idle_buckets:
+                for chat_id, bucket in list(buckets.items()):
+                    if bucket.is_full(now):
+                        del buckets[chat_id]
+
+    def _wake(self):
+        io_loop = IOLoop.current()
+        if self._timeout is not None:
+            io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._dispatch()
+
+    def _dispatch(self):
+        self._timeout = None
+        io_loop = IOLoop.current()
+        now = io_loop.time()
+        wait = None
+        for queue in self._queues:
+            skipped = collections.deque()
+            while queue and not self._bucket.delay(now):
+                request = queue.popleft()
+                buckets = self._get_buckets(request.chat_id,
+                                            request.is_group, now)
+                delay = max([bucket.delay(now) for bucket in buckets] or [0])
+                if delay > 0:
+                    if wait is None or delay < wait:
+                        wait = delay
+                    skipped.append(request)
+                    continue
+                self._bucket.consume(now)
+                for bucket in buckets:
+                    bucket.consume(now)
+                io_loop.spawn_callback(self._send, request)
+            skipped.extend(queue)
+            queue.clear()
+            queue.extend(skipped)
+            delay = self._bucket.delay(now)
+            if delay > 0:
+                if self.queued:
+                    wait = delay
+                break
+        self._prune_buckets(now)
+        if wait is not None:
+            self._timeout = io_loop.call_later(wait, self._dispatch)
+
+    def _pause(self, request, seconds):
+        now = IOLoop.current().time()
+        buckets = self._get_buckets(request.chat_id, request.is_group, now)
+        for bucket in buckets or [self._bucket]:
+            bucket.pause(now, seconds)
+
+    @gen.coroutine
+    def _send(self, request):
+        request.attempts += 1
+        try:
+            result = yield request.send()
+        except BotApiError as e:
+            if (e.retry_after is not None and
+                    request.attempts <= self.max_retries):
+                logging.warning('%s throttled, retrying in %s seconds',
+                                request.method, e.retry_after)
+                self.retried += 1
+                self._pause(request, e.retry_after)
+                self._queues[request.priority].appendleft(request)
+                self._wake()
+                return
+            self.failed += 1
+            request.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            request.future.set_exception(e)
+        else:
+            self.sent += 1
+            request.future.set_result(result)
@@ -0,0 +1,54 @@
+import datetime
+
+from tornado import gen
+from tornado.concurrent import Future
+
+
+def can_reply(update):
+    """Return whether handlers of the update may offer a webhook reply.
+
+    Only inline queries and private messages are answered with a call, so
+    responses to other updates are sent without waiting.
+    """
+    if 'inline_query' in update:
+        return True
+    message = update.get('message')
+    return message is not None and message['chat']['type'] == 'private'
+
+
+class WebhookReply(object):
+    """Bot API call sent in the webhook response to an update.
+
+    The webhook response may carry one method call, which saves an
+    outbound request. The first call offered while the webhook waits for
+    it is taken; later calls, and calls offered after the response was
+    sent, must be sent as usual.
+    """
+
+    def __init__(self):
+        self._future = Future()
+
+    def offer(self, method, params):
+        """Take the call for the response, returning whether it was taken."""
+        if self._future.done():
+            return False
+        call = dict(params or {})
+        call['method'] = method
+        self._future.set_result(call)
+        return True
+
+    def close(self):
+        """Take no more calls."""
+        if not self._future.done():
+            self._future.set_result(None)
+
+    @gen.coroutine
+    def wait(self, timeout):
+        """Return the call offered within ``timeout`` seconds or None."""
+        try:
+            return (yield gen.with_timeout(
+                datetime.timedelta(seconds=timeout), self._future
+            ))
+        except gen.TimeoutError:
+            self.close()
+            return None
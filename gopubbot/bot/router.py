@@ -0,0 +1,80 @@
+import re
+
+
+class UpdateRouter(object):
+    """Compiled update handlers routing table.
+
+    Handler spec patterns are indexed by update type:
+
+    * ``bot_command`` patterns are commands, looked up in a dict both as is
+      and in the ``/command@botname`` form;
+    * ``callback_query`` patterns are callback data actions, the part of
+      the data before the first colon, also looked up in a dict;
+    * ``message`` patterns are regular expressions matched against the
+      message text; they are combined so that messages matching none of
+      them are rejected with a single match.
+
+    Specs without patterns receive every update of their type.
+    """
+
+    def __init__(self, update_handlers, bot_username=None):
+        self.update_handlers = update_handlers
+        self.compile(bot_username)
+
+    def compile(self, bot_username=None):
+        self._handlers = {}
+        self._commands = {}
+        self._actions = {}
+        self._message_patterns = []
+        self._message_regex = None
+
+        for update_type, specs in self.update_handlers.items():
+            self._handlers[update_type] = [
+                spec.handler for spec in specs if spec.patterns is None
+            ]
+
+        for spec in self.update_handlers.get('bot_command', []):
+            for command in spec.patterns or []:
+                keys = [command]
+                if bot_username is not None:
+                    keys.append('{}@{}'.format(command, bot_username))
+                for key in keys:
+                    self._commands.setdefault(key, []).append(spec.handler)
+
+        for spec in self.update_handlers.get('callback_query', []):
+            for action in spec.patterns or []:
+                self._actions.setdefault(action, []).append(spec.handler)
+
+        patterns = []
+        for spec in self.update_handlers.get('message', []):
+            if spec.patterns:
+                patterns.extend(spec.patterns)
+                self._message_patterns.append((
+                    re.compile('|'.join(
+                        '(?:{})'.format(pattern) for pattern in spec.patterns
+                    )),
+                    spec.handler,
+                ))
+        if patterns:
+            self._message_regex = re.compile('|'.join(
+                '(?:{})'.format(pattern) for pattern in patterns
+            ))
+
+    def route(self, update):
+        """Return handlers of the update."""
+        handlers = self._handlers.get(update.update_type, [])
+        if update.update_type == 'bot_command':
+            matched = self._commands.get(update.bot_command)
+        elif update.update_type == 'callback_query':
+            matched = self._actions.get(update.action)
+        elif (update.update_type == 'message' and
+                self._message_regex is not None and
+                update.text is not None and
+                self._message_regex.match(update.text)):
+            matched = [handler for regex, handler in self._message_patterns
+                       if regex.match(update.text)]
+        else:
+            matched = None
+        if matched:
+            return handlers + matched
+        return handlers
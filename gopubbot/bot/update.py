@@ -1,69 +1,111 @@
+import time
 from datetime import datetime
 
 from tornado import gen
 
+from ..utils.metrics import registry
+from .router import UpdateRouter
+
+
+dispatch_seconds = registry.histogram(
+    'gopubbot_dispatch_seconds', 'Update handling time in seconds.',
+    ('update_type', 'handler'),
+)
+
+
+class Field(object):
+    """Update attribute read from the update object data on access."""
+
+    __slots__ = ('key', 'required')
+
+    def __init__(self, key, required=False):
+        self.key = key
+        self.required = required
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.required:
+            return obj._data[self.key]
+        return obj._data.get(self.key, None)
+
 
 class Update(object):
-    """Base class for Telegram Bot API updates."""
+    """Base class for Telegram Bot API updates.
+
+    Attributes are read lazily from the update object data, which is kept
+    as is; ``data_key`` is the update field holding that object.
+    ``webhook_reply`` is the ``WebhookReply`` of an update received by the
+    webhook, if any.
+    """
+
+    __slots__ = ('update_id', 'webhook_reply', '_data')
 
     update_type = None
+    data_key = None
 
     def __init__(self, update):
         self.update_id = update['update_id']
+        self.webhook_reply = None
+        self._data = update[self.data_key]
 
 
 class MessageUpdate(Update):
     """Telegram Bot API message update."""
 
+    __slots__ = ('_date',)
+
     update_type = 'message'
+    data_key = 'message'
+
+    message_id = Field('message_id', required=True)
+    from_user = Field('from')
+    chat = Field('chat', required=True)
+    forward_from = Field('forward_from')
+    forward_from_chat = Field('forward_from_chat')
+    forward_date = Field('forward_date')
+    reply_to_message = Field('reply_to_message')
+    edit_date = Field('edit_date')
+    text = Field('text')
+    entities = Field('entities')
+    audio = Field('audio')
+    document = Field('document')
+    photo = Field('photo')
+    sticker = Field('sticker')
+    video = Field('video')
+    voice = Field('voice')
+    caption = Field('caption')
+    contact = Field('contact')
+    location = Field('location')
+    venue = Field('venue')
+    new_chat_member = Field('new_chat_member')
+    left_chat_member = Field('left_chat_member')
+    new_chat_title = Field('new_chat_title')
+    new_chat_photo = Field('new_chat_photo')
+    delete_chat_photo = Field('delete_chat_photo')
+    group_chat_created = Field('group_chat_created')
+    supergroup_chat_created = Field('supergroup_chat_created')
+    channel_chat_created = Field('channel_chat_created')
+    migrate_to_chat_id = Field('migrate_to_chat_id')
+    migrate_from_chat_id = Field('migrate_from_chat_id')
+    pinned_message = Field('pinned_message')
 
     def __init__(self, update):
         super().__init__(update)
-        message = update['message']
-        self.message_id = message['message_id']
-        self.from_user = message.get('from', None)
-        self.date = datetime.fromtimestamp(message['date'])
-        self.chat = message['chat']
-        self.forward_from = message.get('forward_from', None)
-        self.forward_from_chat = message.get('forward_from_chat', None)
-        try:
-            self.forward_date = message['forward_date']
-        except (KeyError, TypeError):
-            self.forward_date = None
-        self.reply_to_message = message.get('reply_to_message', None)
-        try:
-            self.edit_date = message['edit_date']
-        except (KeyError, TypeError):
-            self.edit_date = None
-        self.text = message.get('text', None)
-        self.entities = message.get('entities', None)
-        self.audio = message.get('audio', None)
-        self.document = message.get('document', None)
-        self.photo = message.get('photo', None)
-        self.sticker = message.get('sticker', None)
-        self.video = message.get('video', None)
-        self.voice = message.get('voice', None)
-        self.caption = message.get('caption', None)
-        self.contact = message.get('contact', None)
-        self.location = message.get('location', None)
-        self.venue = message.get('venue', None)
-        self.new_chat_member = message.get('new_chat_member', None)
-        self.left_chat_member = message.get('left_chat_member', None)
-        self.new_chat_title = message.get('new_chat_title', None)
-        self.new_chat_photo = message.get('new_chat_photo', None)
-        self.delete_chat_photo = message.get('delete_chat_photo', None)
-        self.group_chat_created = message.get('group_chat_created', None)
-        self.supergroup_chat_created = message.get('supergroup_chat_created',
-                                                   None)
-        self.channel_chat_created = message.get('channel_chat_created', None)
-        self.migrate_to_chat_id = message.get('migrate_to_chat_id', None)
-        self.migrate_from_chat_id = message.get('migrate_from_chat_id', None)
-        self.pinned_message = message.get('pinned_message', None)
+        self._date = None
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = datetime.fromtimestamp(self._data['date'])
+        return self._date
 
 
 class BotCommandUpdate(MessageUpdate):
     """Telegram Bot API message update starting with command."""
 
+    __slots__ = ('bot_command',)
+
     update_type = 'bot_command'
 
     def __init__(self, update, entity):
@@ -74,53 +116,81 @@ class BotCommandUpdate(MessageUpdate):
 class EditedMessageUpdate(MessageUpdate):
     """Telegram Bot API edited message update."""
 
+    __slots__ = ()
+
     update_type = 'edited_message'
+    data_key = 'edited_message'
 
 
 class InlineQueryUpdate(Update):
     """Telegram Bot API inline query update."""
 
+    __slots__ = ()
+
     update_type = 'inline_query'
+    data_key = 'inline_query'
 
-    def __init__(self, update):
-        super().__init__(update)
-        inline_query = update['inline_query']
-        self.id = inline_query['id']
-        self.from_user = inline_query['from']
-        self.location = inline_query.get('location', None)
-        self.query = inline_query['query']
-        self.offset = inline_query['offset']
+    id = Field('id', required=True)
+    from_user = Field('from', required=True)
+    location = Field('location')
+    query = Field('query', required=True)
+    offset = Field('offset', required=True)
 
 
 class ChosenInlineResultUpdate(Update):
     """Telegram Bot API chosen inline result update."""
 
+    __slots__ = ()
+
     update_type = 'chosen_inline_result'
+    data_key = 'chosen_inline_result'
 
-    def __init__(self, update):
-        super().__init__(update)
-        chosen_inline_result = update['chosen_inline_result']
-        self.result_id = chosen_inline_result['result_id']
-        self.from_user = chosen_inline_result['from']
-        self.location = chosen_inline_result.get('location', None)
-        self.inline_message_id = chosen_inline_result.get('inline_message_id',
-                                                          None)
-        self.query = chosen_inline_result['query']
+    result_id = Field('result_id', required=True)
+    from_user = Field('from', required=True)
+    location = Field('location')
+    inline_message_id = Field('inline_message_id')
+    query = Field('query', required=True)
 
 
 class CallbackQueryUpdate(Update):
     """Telegram Bot API callback query update."""
 
+    __slots__ = ('_action',)
+
     update_type = 'callback_query'
+    data_key = 'callback_query'
+
+    id = Field('id', required=True)
+    from_user = Field('from', required=True)
+    message = Field('message')
+    inline_message_id = Field('inline_message_id')
+    data = Field('data')
 
     def __init__(self, update):
         super().__init__(update)
-        callback_query = update['callback_query']
-        self.id = callback_query['id']
-        self.from_user = callback_query['from']
-        self.message = callback_query.get('message', None)
-        self.inline_message_id = callback_query.get('inline_message_id', None)
-        self.data = callback_query.get('data', None)
+        self._action = None
+
+    def _parse_data(self):
+        data = self.data
+        if data is None:
+            self._action = (None, [])
+        else:
+            action = data.split(':')
+            self._action = (action[0], action[1:])
+
+    @property
+    def action(self):
+        """Callback data part before the first colon."""
+        if self._action is None:
+            self._parse_data()
+        return self._action[0]
+
+    @property
+    def action_args(self):
+        """Colon separated callback data parts after the action."""
+        if self._action is None:
+            self._parse_data()
+        return self._action[1]
 
 
 class UpdateHandlerSpec(object):
@@ -128,9 +198,12 @@ class UpdateHandlerSpec(object):
 
     def __init__(self, spec):
         self._handler = None
+        self._kwargs = {}
         if isinstance(spec, (list, tuple)):
-            assert len(spec) == 2
-            self._patterns, self._handler_class = spec
+            assert len(spec) in (2, 3)
+            self._patterns, self._handler_class = spec[:2]
+            if len(spec) == 3:
+                self._kwargs = spec[2]
             if isinstance(self._patterns, str):
                 self._patterns = [self._patterns]
         else:
@@ -149,81 +222,89 @@ class UpdateHandlerSpec(object):
     def handler(self):
         return self._handler
 
-    def init_handler(self, *args, **kwargs):
-        self._handler = self._handler_class(*args, **kwargs)
+    def init_handler(self, *args):
+        self._handler = self._handler_class(*args, **self._kwargs)
 
 
 class UpdateDispatcher(object):
-    """Update handlers dispatcher."""
+    """Update handlers dispatcher.
 
-    def __init__(self, update_handlers):
-        self.handlers = update_handlers
+    Handlers of an update are found with the compiled routing table and
+    run concurrently. Updates the ``deduplicator`` has seen before are
+    dropped before parsing. Redelivered updates, e.g. journal entries
+    claimed from a dead consumer, are only checked in process, as their
+    first delivery has already claimed them in storage.
+    """
 
-    @gen.coroutine
-    def dispatch(self, update_data):
+    def __init__(self, update_handlers, deduplicator=None):
+        self.router = UpdateRouter(update_handlers)
+        self.deduplicator = deduplicator
+
+    def compile(self, bot_username=None):
+        """Rebuild the routing table, e.g. once the bot username is known."""
+        self.router.compile(bot_username)
+
+    def parse(self, update_data):
+        """Make update object from the update data."""
         if 'message' in update_data:
-            if ('text' in update_data['message'] and
-                    'entities' in update_data['message']):
-                for entity in update_data['message']['entities']:
+            message = update_data['message']
+            if 'text' in message and 'entities' in message:
+                for entity in message['entities']:
                     if (entity['type'] == 'bot_command' and
                             entity['offset'] == 0):
-                        update = BotCommandUpdate(update_data, entity)
-                        yield self.find_bot_command_handlers(update)
-                        return
-            update = MessageUpdate(update_data)
-            yield self.find_message_handlers(update)
-
+                        return BotCommandUpdate(update_data, entity)
+            return MessageUpdate(update_data)
         elif 'edited_message' in update_data:
-            update = EditedMessageUpdate(update_data)
-            yield self.find_edited_message_handlers(update)
-
+            return EditedMessageUpdate(update_data)
         elif 'inline_query' in update_data:
-            update = InlineQueryUpdate(update_data)
-            yield self.find_inline_query_handlers(update)
-
+            return InlineQueryUpdate(update_data)
         elif 'chosen_inline_result' in update_data:
-            update = ChosenInlineResultUpdate(update_data)
-            yield self.find_chosen_inline_result_handlers(update)
-
+            return ChosenInlineResultUpdate(update_data)
         elif 'callback_query' in update_data:
-            update = CallbackQueryUpdate(update_data)
-            yield self.find_callback_query_handlers(update)
-
-    @gen.coroutine
-    def find_message_handlers(self, update):
-        handlers = self.handlers['message']
-        yield [spec.handler.handle(update) for spec in handlers]
-
-    @gen.coroutine
-    def find_bot_command_handlers(self, update):
-        for spec in self.handlers['bot_command']:
-            if spec.patterns is None:
-                yield spec.handler.handle(update)
-            elif update.bot_command in spec.patterns:
-                yield spec.handler.handle(update)
+            return CallbackQueryUpdate(update_data)
+        return None
 
     @gen.coroutine
-    def find_inline_query_handlers(self, update):
-        handlers = self.handlers['inline_query']
-        yield [spec.handler.handle(update) for spec in handlers]
+    def dispatch(self, update_data, reply=None, redelivered=False):
+        if self.deduplicator is not None and (
+                yield self.deduplicator.is_duplicate(
+                    update_data['update_id'], shared=not redelivered)):
+            return
+        update = self.parse(update_data)
+        if update is None:
+            return
+        update.webhook_reply = reply
+        handlers = self.router.route(update)
+        if len(handlers) == 1:
+            yield self.handle(handlers[0], update)
+        elif handlers:
+            yield [self.handle(handler, update) for handler in handlers]
 
     @gen.coroutine
-    def find_chosen_inline_result_handlers(self, update):
-        handlers = self.handlers['chosen_inline_result']
-        yield [spec.handler.handle(update) for spec in handlers]
-
-    @gen.coroutine
-    def find_callback_query_handlers(self, update):
-        handlers = self.handlers['callback_query']
-        yield [spec.handler.handle(update) for spec in handlers]
+    def handle(self, handler, update):
+        """Run the handler, measuring its time."""
+        start = time.perf_counter()
+        try:
+            yield handler.handle(update)
+        finally:
+            dispatch_seconds.labels(
+                update.update_type, handler.__class__.__name__
+            ).observe(time.perf_counter() - start)
 
 
 class UpdateHandler(object):
     """Base class for Telegram Bot API update handlers."""
 
-    def __init__(self, api, redis):
+    def __init__(self, api, storage, **kwargs):
         self.api = api
-        self.redis = redis
+        self.storage = storage
+        self.initialize(**kwargs)
+
+    def initialize(self):
+        """Hook for handler initialization.
+
+        Called with the keyword arguments from the handler spec.
+        """
 
     @gen.coroutine
     def handle(self, update):
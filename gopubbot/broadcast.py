@@ -0,0 +1,287 @@
+"""Messages sent to all participants of an event.
+
+A broadcast job walks the event participants with ``ZSCAN`` (``SSCAN`` for
+events still stored as a set) in batches and sends each batch with a pool
+of concurrent workers. Requests go through the Bot API request scheduler
+at low priority, so broadcasts take the capacity left by interactive
+replies and never exceed the limits.
+
+Job state lives in Redis: the scan cursor is saved after every batch and
+recipients are recorded as they are handled, so a restarted bot resumes
+unfinished jobs without messaging anyone twice. A job runs only while its
+runner holds the job lock, renewed before every batch, so a job is never
+run twice at once. Recipients who blocked the bot, or whose messages fail
+otherwise, are counted and skipped.
+
+Jobs are started with ``Broadcaster.start`` or queued from the command
+line with ``--broadcast_event`` and ``--broadcast_text``; the running bot
+picks queued jobs up.
+"""
+
+import collections
+import logging
+import uuid
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .bot.exceptions import BotApiError
+from .bot.ratelimit import PRIORITY_LOW
+from .events import get_event_keys
+from .storage.base import Script
+from .utils import codec
+from .utils.metrics import registry
+
+
+BROADCAST_ID_KEY = 'broadcast:id'
+ACTIVE_BROADCASTS_KEY = 'broadcast:active'
+
+broadcast_messages = registry.counter(
+    'gopubbot_broadcast_messages_total',
+    'Broadcast messages by result: sent, blocked or failed.', ('result',),
+)
+
+# KEYS: lock
+# ARGV: token, TTL
+RENEW_LOCK_SCRIPT = Script('''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('EXPIRE', KEYS[1], ARGV[2])
+''')
+
+# KEYS: lock
+# ARGV: token
+RELEASE_LOCK_SCRIPT = Script('''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+''')
+
+BroadcastJob = collections.namedtuple(
+    'BroadcastJob', ['id', 'event_id', 'text', 'options', 'cursor']
+)
+
+
+def get_broadcast_keys(job_id):
+    return (
+        'broadcast:{}'.format(job_id),
+        'broadcast:{}:handled'.format(job_id),
+        'broadcast:{}:lock'.format(job_id),
+    )
+
+
+class Broadcaster(object):
+    """Broadcast jobs runner.
+
+    Batches of about ``batch_size`` participants are sent by up to
+    ``workers`` concurrent requests. Progress and throughput are logged
+    every ``progress_interval`` seconds. Finished jobs are kept for
+    ``ttl`` seconds. The job lock expires ``lock_ttl`` seconds after it
+    was last renewed, and ``resume`` checks for unfinished jobs every
+    ``poll_interval`` seconds. A runner stops once its lock has been lost,
+    or after ``max_failures`` failed batches in a row, releasing the lock
+    so that ``resume`` retries the job later.
+    """
+
+    def __init__(self, api, storage, workers=16, batch_size=100,
+                 progress_interval=10, ttl=7 * 24 * 60 * 60, lock_ttl=5 * 60,
+                 poll_interval=60, max_failures=10):
+        self.api = api
+        self.storage = storage
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.max_failures = max_failures
+
+    @gen.coroutine
+    def create(self, event_id, text, **options):
+        """Queue a job sending the message to the event participants.
+
+        ``options`` are ``send_message`` arguments. Returns the job id.
+        """
+        job_id = yield self.storage.incr(BROADCAST_ID_KEY)
+        job_key = get_broadcast_keys(job_id)[0]
+        yield self.storage.pipeline([
+            ('HMSET', job_key, 'event_id', event_id, 'text', text,
+             'options', codec.dumps(options), 'cursor', 0),
+            ('SADD', ACTIVE_BROADCASTS_KEY, job_id),
+        ])
+        return job_id
+
+    @gen.coroutine
+    def start(self, event_id, text, **options):
+        """Create a job and run it in the background; return its id."""
+        job_id = yield self.create(event_id, text, **options)
+        IOLoop.current().spawn_callback(self.run, job_id)
+        return job_id
+
+    @gen.coroutine
+    def resume(self):
+        """Run unfinished jobs, e.g. left by a restart or queued."""
+        while True:
+            try:
+                job_ids = yield self.storage.smembers(ACTIVE_BROADCASTS_KEY)
+            except Exception:
+                logging.exception('Error reading active broadcasts')
+            else:
+                for job_id in job_ids:
+                    IOLoop.current().spawn_callback(self.run, job_id)
+            yield gen.sleep(self.poll_interval)
+
+    @gen.coroutine
+    def get_job(self, job_id):
+        reply = yield self.storage.execute(
+            'HMGET', get_broadcast_keys(job_id)[0],
+            'event_id', 'text', 'options', 'cursor'
+        )
+        event_id, text, options, cursor = reply
+        if event_id is None:
+            return None
+        return BroadcastJob(job_id, event_id, text, codec.loads(options),
+                            cursor)
+
+    @gen.coroutine
+    def get_progress(self, job_id):
+        """Return counts of recipients by result."""
+        reply = yield self.storage.execute(
+            'HMGET', get_broadcast_keys(job_id)[0], 'sent', 'blocked',
+            'failed'
+        )
+        return {
+            result: int(count or 0)
+            for result, count in zip(('sent', 'blocked', 'failed'), reply)
+        }
+
+    @gen.coroutine
+    def scan(self, key, cursor):
+        """Return the next cursor and batch of member ids of the set."""
+        key_type = yield self.storage.execute('TYPE', key)
+        if key_type == 'set':
+            cursor, user_ids = yield self.storage.execute(
+                'SSCAN', key, cursor, 'COUNT', self.batch_size
+            )
+        elif key_type == 'zset':
+            cursor, members = yield self.storage.execute(
+                'ZSCAN', key, cursor, 'COUNT', self.batch_size
+            )
+            user_ids = members[::2]
+        else:
+            return '0', []
+        return cursor, user_ids
+
+    @gen.coroutine
+    def run(self, job_id):
+        """Run the job unless another runner holds its lock."""
+        job_key, handled_key, lock_key = get_broadcast_keys(job_id)
+        token = uuid.uuid4().hex
+        locked = yield self.storage.execute('SET', lock_key, token, 'NX',
+                                            'EX', self.lock_ttl)
+        if locked is None:
+            return
+        job = yield self.get_job(job_id)
+        if job is None:
+            yield self.storage.execute('SREM', ACTIVE_BROADCASTS_KEY, job_id)
+            yield RELEASE_LOCK_SCRIPT(self.storage, (lock_key,), (token,))
+            return
+        participants_key = get_event_keys(job.event_id)[1]
+        io_loop = IOLoop.current()
+        started = reported = io_loop.time()
+        counts = collections.Counter()
+        cursor = job.cursor
+        failures = 0
+        while True:
+            try:
+                renewed = yield RENEW_LOCK_SCRIPT(
+                    self.storage, (lock_key,), (token, self.lock_ttl)
+                )
+                if not renewed:
+                    logging.warning('Broadcast %s lock lost, stopping',
+                                    job_id)
+                    return
+                next_cursor, user_ids = yield self.scan(participants_key,
+                                                        cursor)
+                yield self.send_batch(job, user_ids, counts)
+                yield self.storage.execute('HSET', job_key, 'cursor',
+                                           next_cursor)
+                cursor = next_cursor
+                failures = 0
+            except Exception:
+                logging.exception('Error running broadcast %s', job_id)
+                failures += 1
+                if failures >= self.max_failures:
+                    yield self.release(lock_key, token)
+                    return
+                yield gen.sleep(self.progress_interval)
+                continue
+            now = io_loop.time()
+            if cursor == '0' or now - reported >= self.progress_interval:
+                reported = now
+                logging.info(
+                    'Broadcast %s: %d sent, %d blocked, %d failed, '
+                    '%.1f messages/s', job_id, counts['sent'],
+                    counts['blocked'], counts['failed'],
+                    sum(counts.values()) / max(now - started, 1e-3)
+                )
+            if cursor == '0':
+                break
+        yield self.storage.pipeline([
+            ('SREM', ACTIVE_BROADCASTS_KEY, job_id),
+            ('EXPIRE', job_key, self.ttl),
+            ('EXPIRE', handled_key, self.ttl),
+        ])
+        yield RELEASE_LOCK_SCRIPT(self.storage, (lock_key,), (token,))
+
+    @gen.coroutine
+    def release(self, lock_key, token):
+        """Release the job lock if still held, so the job is retried."""
+        try:
+            yield RELEASE_LOCK_SCRIPT(self.storage, (lock_key,), (token,))
+        except Exception:
+            logging.exception('Error releasing broadcast lock %s', lock_key)
+
+    @gen.coroutine
+    def send_batch(self, job, user_ids, counts):
+        handled_key = get_broadcast_keys(job.id)[1]
+        handled = yield self.storage.pipeline([
+            ('SISMEMBER', handled_key, user_id) for user_id in user_ids
+        ])
+        recipients = collections.deque(
+            user_id for user_id, is_handled in zip(user_ids, handled)
+            if not is_handled
+        )
+
+        @gen.coroutine
+        def worker():
+            while recipients:
+                user_id = recipients.popleft()
+                result = yield self.send(job, user_id)
+                counts[result] += 1
+                broadcast_messages.labels(result).inc()
+
+        yield [worker() for i in range(min(self.workers, len(recipients)))]
+
+    @gen.coroutine
+    def send(self, job, user_id):
+        """Send the message to the user, returning the result."""
+        try:
+            yield self.api.send_message(user_id, job.text,
+                                        priority=PRIORITY_LOW, **job.options)
+        except BotApiError as e:
+            result = 'blocked' if e.error_code == 403 else 'failed'
+        except Exception:
+            logging.exception('Error sending broadcast %s to %s', job.id,
+                              user_id)
+            result = 'failed'
+        else:
+            result = 'sent'
+        job_key, handled_key = get_broadcast_keys(job.id)[:2]
+        yield self.storage.pipeline([
+            ('SADD', handled_key, user_id),
+            ('HINCRBY', job_key, result, 1),
+        ])
+        return result
@@ -0,0 +1,618 @@
+"""Pub event repository.
+
+Every operation that changes or reads an event runs as a single Lua script
+so it takes one round-trip and returns a consistent snapshot of the event.
+Scripts only touch the keys they are given, so creating an event takes the
+event id in a separate script first, and participants stored by older
+versions are upgraded by a separate script before the operation is retried.
+
+Participants are kept in a sorted set ordered by join time, and display
+names of all users in a single hash, so rendering an event reads only the
+first ``participants_limit`` names and the participant count however many
+users joined. The time a name was last written is kept in a sorted set,
+so ``EventSweeper`` can forget names of users in no live event.
+
+Event keys expire ``event_ttl`` seconds after the event was created or its
+participants last changed; ``EventSweeper`` sets the TTL on keys stored
+without one and removes keys left over from expired events.
+
+Every placement of an event message, a chat message or an inline message
+shared to a chat, is recorded so that all copies can be refreshed, and
+expires with the other event keys.
+
+Each membership change bumps the event version. Rendered event text may be
+cached in Redis under that version; scripts skip fetching participant
+names when the caller already has, or Redis holds, the text rendered for
+the current version.
+"""
+
+import collections
+import logging
+import time
+
+from tornado import gen
+
+from .storage.base import Script
+from .storage.exceptions import StorageReplyError
+from .utils.metrics import registry
+
+
+EVENT_ID_KEY = 'event:id'
+USER_NAMES_KEY = 'user:names'
+USER_NAMES_SEEN_KEY = 'user:names:seen'
+
+swept_keys = registry.counter(
+    'gopubbot_sweeper_keys_total',
+    'Stale keys and user names handled by the sweeper.', ('action',),
+)
+reclaimed_bytes = registry.counter(
+    'gopubbot_sweeper_reclaimed_bytes_total',
+    'Memory used by keys deleted by the sweeper.',
+)
+sweep_seconds = registry.gauge(
+    'gopubbot_sweeper_last_sweep_seconds', 'Duration of the last sweep.',
+)
+
+TOUCH_EVENT = '''
+local function touch_event(text_key, participants_key, version_key,
+                           placements_key, ttl)
+    redis.call('EXPIRE', text_key, ttl)
+    redis.call('EXPIRE', participants_key, ttl)
+    redis.call('EXPIRE', version_key, ttl)
+    redis.call('EXPIRE', placements_key, ttl)
+end
+'''
+
+# Moves the name from a JSON profile stored by older versions under a
+# 'user:<id>' key to the names hash and deletes the profile.
+MIGRATE_PROFILE = '''
+local function migrate_profile(profile_key, names_key, id)
+    local profile = redis.call('GET', profile_key)
+    if not profile then
+        return
+    end
+    local user = cjson.decode(profile)
+    local name
+    if user.username then
+        name = '@' .. user.username
+    else
+        name = user.first_name
+        if user.last_name then
+            name = name .. ' ' .. user.last_name
+        end
+    end
+    redis.call('HSETNX', names_key, id, name)
+    redis.call('DEL', profile_key)
+end
+'''
+
+# Converts participants stored by older versions as a set of user ids with
+# JSON profiles under 'user:<id>' keys, given as KEYS from the third on
+# with their user ids as ARGV.
+# KEYS: participants, user names, profiles...
+# ARGV: user ids...
+UPGRADE_PARTICIPANTS_SCRIPT = Script(MIGRATE_PROFILE + '''
+if redis.call('TYPE', KEYS[1]).ok ~= 'set' then
+    return 0
+end
+local ids = redis.call('SMEMBERS', KEYS[1])
+redis.call('DEL', KEYS[1])
+for i, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[1], 0, id)
+end
+for i, id in ipairs(ARGV) do
+    migrate_profile(KEYS[i + 2], KEYS[2], id)
+end
+return 1
+''')
+
+# Scripts reading participants return this when they are still stored by
+# older versions, to be upgraded first.
+UPGRADE_NEEDED = 'upgrade'
+
+# Records the placement of the message whose button was pressed, which may
+# have been placed before placements were recorded or not reported.
+RECORD_PLACEMENT = '''
+local function record_placement(placements_key, placement, ttl)
+    if placement ~= '' and
+            redis.call('SADD', placements_key, placement) == 1 then
+        redis.call('EXPIRE', placements_key, ttl)
+    end
+end
+'''
+
+# Returns {version, text, names, count, rendered} for the event. Names and
+# count are omitted when the known version is current or rendered text is
+# cached.
+RENDER_PAYLOAD = TOUCH_EVENT + '''
+local function needs_upgrade(participants_key)
+    return redis.call('TYPE', participants_key).ok == 'set'
+end
+
+local function render_payload(participants_key, version_key, rendered_key,
+                              names_key, known_version, limit, text)
+    local version = tonumber(redis.call('GET', version_key) or 0)
+    if version == tonumber(known_version) then
+        return {version, text, false, false, false}
+    end
+    if rendered_key then
+        local rendered = redis.call('HMGET', rendered_key, 'version', 'text')
+        if tonumber(rendered[1]) == version then
+            return {version, text, false, false, rendered[2]}
+        end
+    end
+    local count = redis.call('ZCARD', participants_key)
+    local names = {}
+    if count > 0 then
+        local ids = redis.call('ZRANGE', participants_key, 0, limit - 1)
+        names = redis.call('HMGET', names_key, unpack(ids))
+    end
+    return {version, text, names, count, false}
+end
+'''
+
+# KEYS: state, event id
+CLAIM_EVENT_ID_SCRIPT = Script('''
+if redis.call('GET', KEYS[1]) ~= 'go' then
+    return nil
+end
+return redis.call('INCR', KEYS[2])
+''')
+
+# KEYS: state, text, participants, version, rendered, user names,
+#       placements, user names seen
+# ARGV: user id, user name, event text, join time, participants limit,
+#       event TTL
+CREATE_SCRIPT = Script(RENDER_PAYLOAD + '''
+if redis.call('GET', KEYS[1]) ~= 'go' then
+    return nil
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[6], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[8], ARGV[4], ARGV[1])
+redis.call('SET', KEYS[2], ARGV[3])
+redis.call('ZADD', KEYS[3], ARGV[4], ARGV[1])
+redis.call('SET', KEYS[4], 1)
+touch_event(KEYS[2], KEYS[3], KEYS[4], KEYS[7], ARGV[6])
+return render_payload(KEYS[3], KEYS[4], nil, KEYS[6], nil, ARGV[5], ARGV[3])
+''')
+
+# KEYS: text, participants, version, rendered, user names, placements,
+#       user names seen
+# ARGV: user id, user name, join time, participants limit, event TTL,
+#       placement
+# Placements are returned, last, if participants changed.
+JOIN_SCRIPT = Script(RENDER_PAYLOAD + RECORD_PLACEMENT + '''
+local text = redis.call('GET', KEYS[1])
+if not text then
+    return nil
+end
+if needs_upgrade(KEYS[2]) then
+    return 'upgrade'
+end
+record_placement(KEYS[6], ARGV[6], ARGV[5])
+redis.call('HSET', KEYS[5], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[7], ARGV[3], ARGV[1])
+local changed = redis.call('ZADD', KEYS[2], 'NX', ARGV[3], ARGV[1])
+if changed == 1 then
+    redis.call('INCR', KEYS[3])
+    redis.call('DEL', KEYS[4])
+    touch_event(KEYS[1], KEYS[2], KEYS[3], KEYS[6], ARGV[5])
+end
+local payload = render_payload(KEYS[2], KEYS[3], KEYS[4], KEYS[5], nil,
+                               ARGV[4], text)
+table.insert(payload, 1, changed)
+table.insert(payload, changed == 1 and redis.call('SMEMBERS', KEYS[6]))
+return payload
+''')
+
+# KEYS: text, participants, version, rendered, user names, placements,
+#       user names seen
+# ARGV: user id, participants limit, event TTL, placement
+# Placements are returned, last, if participants changed.
+LEAVE_SCRIPT = Script(RENDER_PAYLOAD + RECORD_PLACEMENT + '''
+local text = redis.call('GET', KEYS[1])
+if not text then
+    return nil
+end
+if needs_upgrade(KEYS[2]) then
+    return 'upgrade'
+end
+record_placement(KEYS[6], ARGV[4], ARGV[3])
+local changed = redis.call('ZREM', KEYS[2], ARGV[1])
+if changed == 1 then
+    redis.call('INCR', KEYS[3])
+    redis.call('DEL', KEYS[4])
+    touch_event(KEYS[1], KEYS[2], KEYS[3], KEYS[6], ARGV[3])
+end
+local payload = render_payload(KEYS[2], KEYS[3], KEYS[4], KEYS[5], nil,
+                               ARGV[2], text)
+table.insert(payload, 1, changed)
+table.insert(payload, changed == 1 and redis.call('SMEMBERS', KEYS[6]))
+return payload
+''')
+
+# KEYS: text, participants, version, rendered, user names, placements,
+#       user names seen
+# ARGV: known version, participants limit
+GET_SCRIPT = Script(RENDER_PAYLOAD + '''
+local text = redis.call('GET', KEYS[1])
+if not text then
+    return nil
+end
+if needs_upgrade(KEYS[2]) then
+    return 'upgrade'
+end
+return render_payload(KEYS[2], KEYS[3], KEYS[4], KEYS[5], ARGV[1], ARGV[2],
+                      text)
+''')
+
+# KEYS: profile, user names
+# ARGV: user id
+MIGRATE_PROFILE_SCRIPT = Script(MIGRATE_PROFILE + '''
+migrate_profile(KEYS[1], KEYS[2], ARGV[1])
+''')
+
+# KEYS: user names, user names seen
+# ARGV: cutoff time, user ids
+FORGET_NAMES_SCRIPT = Script('''
+local forgotten = 0
+for i = 2, #ARGV do
+    local seen = redis.call('ZSCORE', KEYS[2], ARGV[i])
+    if not seen or tonumber(seen) < tonumber(ARGV[1]) then
+        forgotten = forgotten + redis.call('HDEL', KEYS[1], ARGV[i])
+        redis.call('ZREM', KEYS[2], ARGV[i])
+    end
+end
+return forgotten
+''')
+
+
+Event = collections.namedtuple(
+    'Event', ['id', 'version', 'text', 'participants', 'participant_count',
+              'rendered']
+)
+
+
+def get_event_keys(event_id):
+    return (
+        'event:{}:text'.format(event_id),
+        'event:{}:participants'.format(event_id),
+        'event:{}:version'.format(event_id),
+        'event:{}:rendered'.format(event_id),
+        USER_NAMES_KEY,
+        get_placements_key(event_id),
+        USER_NAMES_SEEN_KEY,
+    )
+
+
+def get_placements_key(event_id):
+    return 'event:{}:placements'.format(event_id)
+
+
+def make_placement(chat_id=None, message_id=None, inline_message_id=None):
+    """Return the placement id of a chat message or inline message."""
+    if inline_message_id is not None:
+        return 'inline:{}'.format(inline_message_id)
+    return 'chat:{}:{}'.format(chat_id, message_id)
+
+
+def parse_placement(placement):
+    """Return ``edit_message_text`` arguments locating the placement."""
+    kind, _, location = placement.partition(':')
+    if kind == 'inline':
+        return {'inline_message_id': location}
+    chat_id, message_id = location.rsplit(':', 1)
+    return {'chat_id': int(chat_id), 'message_id': int(message_id)}
+
+
+def get_state_key(user_id):
+    return 'user:{}:state'.format(user_id)
+
+
+def get_display_name(user):
+    """Return the name the user is shown by in event messages."""
+    if 'username' in user:
+        return '@' + user['username']
+    name = user['first_name']
+    if 'last_name' in user:
+        name += ' ' + user['last_name']
+    return name
+
+
+def make_event(event_id, payload):
+    version, text, participants, participant_count, rendered = payload
+    if participants is not None:
+        participants = [name for name in participants if name]
+    return Event(event_id, version, text, participants, participant_count,
+                 rendered)
+
+
+def make_change(event_id, payload):
+    if payload is None:
+        return False, None, []
+    return (bool(payload[0]), make_event(event_id, payload[1:6]),
+            payload[6] or [])
+
+
+class EventRepository(object):
+    """Pub events stored in Redis.
+
+    Events carry display names of at most ``participants_limit`` first
+    joined participants along with the participant count. Events expire
+    ``event_ttl`` seconds after the last change; a started event is
+    abandoned if no text is received in ``state_ttl`` seconds.
+    """
+
+    def __init__(self, storage, rendered_ttl=24 * 60 * 60,
+                 participants_limit=50, event_ttl=30 * 24 * 60 * 60,
+                 state_ttl=60 * 60):
+        assert participants_limit > 0
+        self.storage = storage
+        self.rendered_ttl = rendered_ttl
+        self.participants_limit = participants_limit
+        self.event_ttl = event_ttl
+        self.state_ttl = state_ttl
+
+    def start(self, user_id):
+        """Wait for the event text from the user."""
+        return self.storage.set(get_state_key(user_id), 'go',
+                                ex=self.state_ttl)
+
+    @gen.coroutine
+    def create(self, user, text):
+        """Create an event if the user started one.
+
+        Returns the new event or None if the user is not creating one.
+        """
+        state_key = get_state_key(user['id'])
+        # The id is taken first so that all event keys can be declared.
+        event_id = yield CLAIM_EVENT_ID_SCRIPT(self.storage,
+                                               (state_key, EVENT_ID_KEY))
+        if event_id is None:
+            return None
+        payload = yield CREATE_SCRIPT(
+            self.storage, (state_key,) + get_event_keys(event_id), (
+                user['id'], get_display_name(user), text, time.time(),
+                self.participants_limit, self.event_ttl,
+            )
+        )
+        if payload is None:
+            return None
+        return make_event(event_id, payload)
+
+    @gen.coroutine
+    def run_script(self, script, event_id, args):
+        """Run the event script, upgrading participants first if needed."""
+        keys = get_event_keys(event_id)
+        payload = yield script(self.storage, keys, args)
+        if payload == UPGRADE_NEEDED:
+            yield self.upgrade_participants(event_id)
+            payload = yield script(self.storage, keys, args)
+        return payload
+
+    @gen.coroutine
+    def upgrade_participants(self, event_id):
+        """Convert participants stored by older versions."""
+        participants_key = get_event_keys(event_id)[1]
+        user_ids = yield self.storage.smembers(participants_key)
+        yield UPGRADE_PARTICIPANTS_SCRIPT(
+            self.storage,
+            (participants_key, USER_NAMES_KEY) + tuple(
+                'user:{}'.format(user_id) for user_id in user_ids
+            ),
+            user_ids,
+        )
+
+    @gen.coroutine
+    def get(self, event_id, known_version=None):
+        """Return the event or None if it does not exist.
+
+        Participants are not fetched if ``known_version`` is the current
+        event version or the current rendered text is cached.
+        """
+        if known_version is None:
+            known_version = ''
+        payload = yield self.run_script(
+            GET_SCRIPT, event_id, (known_version, self.participants_limit)
+        )
+        if payload is None:
+            return None
+        return make_event(event_id, payload)
+
+    @gen.coroutine
+    def join(self, event_id, user, placement=None):
+        """Add the user to event participants.
+
+        ``placement``, the message the user pressed the button in, is
+        recorded. Returns a ``(changed, event, placements)`` tuple; event
+        is None if it does not exist and placements are only returned if
+        participants changed.
+        """
+        payload = yield self.run_script(JOIN_SCRIPT, event_id, (
+            user['id'], get_display_name(user), time.time(),
+            self.participants_limit, self.event_ttl, placement or '',
+        ))
+        return make_change(event_id, payload)
+
+    @gen.coroutine
+    def leave(self, event_id, user_id, placement=None):
+        """Remove the user from event participants.
+
+        Takes and returns the same as ``join``.
+        """
+        payload = yield self.run_script(LEAVE_SCRIPT, event_id, (
+            user_id, self.participants_limit, self.event_ttl, placement or '',
+        ))
+        return make_change(event_id, payload)
+
+    def add_placement(self, event_id, placement):
+        """Record a placement of the event message."""
+        key = get_placements_key(event_id)
+        return self.storage.pipeline([
+            ('SADD', key, placement),
+            ('EXPIRE', key, self.event_ttl),
+        ])
+
+    def get_placements(self, event_id):
+        """Return placements of the event message."""
+        return self.storage.smembers(get_placements_key(event_id))
+
+    def remove_placement(self, event_id, placement):
+        """Forget a placement, e.g. a deleted message."""
+        return self.storage.execute('SREM', get_placements_key(event_id),
+                                    placement)
+
+    def save_rendered(self, event_id, version, text):
+        """Cache the event text rendered for the given version."""
+        rendered_key = get_event_keys(event_id)[3]
+        return self.storage.pipeline([
+            ('HMSET', rendered_key, 'version', version, 'text', text),
+            ('EXPIRE', rendered_key, self.rendered_ttl),
+        ])
+
+
+class EventSweeper(object):
+    """Background cleanup of stale event and user state keys.
+
+    Every ``interval`` seconds the keys are walked with ``SCAN`` in batches
+    of about ``batch_size`` keys, sleeping ``batch_delay`` seconds between
+    batches so update dispatch is never held up. Event and state keys
+    stored without a TTL, e.g. by older versions, get one; keys of events
+    whose text is gone are deleted. User profiles stored by older versions
+    are moved to the names hash, and names of users who are in no live
+    event and were not seen since the sweep started are forgotten.
+    The memory usage of deleted keys is measured on Redis 4.0 and later
+    only; older servers report no reclaimed bytes.
+    """
+
+    def __init__(self, storage, event_ttl=30 * 24 * 60 * 60,
+                 state_ttl=60 * 60, interval=60 * 60, batch_size=100,
+                 batch_delay=0.1):
+        self.storage = storage
+        self.event_ttl = event_ttl
+        self.state_ttl = state_ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._referenced = set()
+
+    @gen.coroutine
+    def run(self):
+        while True:
+            start = time.perf_counter()
+            try:
+                yield self.sweep()
+            except Exception:
+                logging.exception('Error sweeping stale keys')
+            sweep_seconds.set(time.perf_counter() - start)
+            yield gen.sleep(self.interval)
+
+    @gen.coroutine
+    def sweep(self):
+        started = time.time()
+        self._referenced = set()
+        try:
+            yield self.scan('event:*:*', self.sweep_event_keys)
+            yield self.scan('user:*:state', self.sweep_state_keys)
+            yield self.scan('user:[0-9]*', self.sweep_profile_keys)
+            yield self.sweep_names(started)
+        finally:
+            self._referenced = set()
+
+    @gen.coroutine
+    def scan(self, match, callback):
+        cursor = '0'
+        while True:
+            cursor, keys = yield self.storage.execute(
+                'SCAN', cursor, 'MATCH', match, 'COUNT', self.batch_size
+            )
+            if keys:
+                yield callback(keys)
+            if cursor == '0':
+                return
+            yield gen.sleep(self.batch_delay)
+
+    @gen.coroutine
+    def expire_persistent(self, keys, ttl):
+        """Set the TTL on the keys that have none."""
+        ttls = yield self.storage.pipeline([('TTL', key) for key in keys])
+        keys = [key for key, key_ttl in zip(keys, ttls) if key_ttl == -1]
+        if keys:
+            yield self.storage.pipeline([
+                ('EXPIRE', key, ttl) for key in keys
+            ])
+            swept_keys.labels('expire').inc(len(keys))
+
+    @gen.coroutine
+    def sweep_event_keys(self, keys):
+        text_keys = ['event:{}:text'.format(key.split(':')[1])
+                     for key in keys]
+        exists = yield self.storage.pipeline([
+            ('EXISTS', text_key) for text_key in text_keys
+        ])
+        stale = [key for key, text_exists in zip(keys, exists)
+                 if not text_exists]
+        if stale:
+            try:
+                sizes = yield self.storage.pipeline([
+                    ('MEMORY', 'USAGE', key) for key in stale
+                ])
+            except StorageReplyError:
+                # MEMORY USAGE is not supported before Redis 4.0.
+                sizes = ()
+            deleted = yield self.storage.delete(*stale)
+            swept_keys.labels('delete').inc(deleted)
+            reclaimed_bytes.inc(sum(size or 0 for size in sizes))
+        live = [key for key, text_exists in zip(keys, exists) if text_exists]
+        if live:
+            yield self.expire_persistent(live, self.event_ttl)
+            yield self.collect_participants([
+                key for key in live if key.endswith(':participants')
+            ])
+
+    @gen.coroutine
+    def collect_participants(self, keys):
+        """Remember ids of live event participants, whose names are kept."""
+        if not keys:
+            return
+        types = yield self.storage.pipeline([('TYPE', key) for key in keys])
+        members = yield self.storage.pipeline([
+            ('SMEMBERS', key) if key_type == 'set' else ('ZRANGE', key, 0, -1)
+            for key, key_type in zip(keys, types)
+        ])
+        for ids in members:
+            self._referenced.update(ids)
+
+    @gen.coroutine
+    def sweep_profile_keys(self, keys):
+        for key in keys:
+            user_id = key.split(':')[1]
+            if key == 'user:' + user_id:
+                yield MIGRATE_PROFILE_SCRIPT(
+                    self.storage, (key, USER_NAMES_KEY), (user_id,)
+                )
+                swept_keys.labels('migrate').inc()
+
+    @gen.coroutine
+    def sweep_names(self, started):
+        """Forget names of users in no live event not seen since started."""
+        cursor = '0'
+        while True:
+            cursor, fields = yield self.storage.execute(
+                'HSCAN', USER_NAMES_KEY, cursor, 'COUNT', self.batch_size
+            )
+            user_ids = [user_id for user_id in fields[::2]
+                        if user_id not in self._referenced]
+            if user_ids:
+                forgotten = yield FORGET_NAMES_SCRIPT(
+                    self.storage, (USER_NAMES_KEY, USER_NAMES_SEEN_KEY),
+                    (started, *user_ids)
+                )
+                swept_keys.labels('forget').inc(forgotten)
+            if cursor == '0':
+                return
+            yield gen.sleep(self.batch_delay)
+
+    def sweep_state_keys(self, keys):
+        return self.expire_persistent(keys, self.state_ttl)
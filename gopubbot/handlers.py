@@ -1,27 +1,57 @@
+import functools
 import html
 
-import simplejson as json
 from tornado import gen
+from tornado.ioloop import IOLoop
 
+from .bot.edits import EditScheduler
+from .bot.exceptions import BotApiError
 from .bot.update import UpdateHandler
+from .events import EventRepository, make_placement, parse_placement
+from .utils import codec
+from .utils.cache import LRUCache
 
 
-def render_event_message(event_id, event_text, participants):
-    """Render event message text."""
-    text = '\U0001F37A <b>{}</b>\n<i>(id: {})</i>\n\n'.format(event_text,
-                                                              event_id)
-    if participants:
-        users = []
-        for participant in participants:
-            user = json.loads(participant)
-            if 'username' in user:
-                name = '@' + user['username']
-            else:
-                name = user['first_name']
-                if 'last_name' in user:
-                    name += ' ' + user['last_name']
-            users.append(html.escape(name))
-        text += 'Идут ({}):\n{}\n'.format(len(users), ', '.join(users))
+MESSAGE_LIMIT = 4096
+
+# Event id -> (version, rendered text).
+rendered_events = LRUCache(1024)
+
+# Event id -> (version, encoded inline query results, time checked).
+inline_answers = LRUCache(1024)
+
+
+def render_event_message(event_id, event_text, participants, count=None):
+    """Render event message text.
+
+    ``participants`` are display names of the first of ``count``
+    participants; the rest, and names that do not fit in a message, are
+    only counted. Event text too long to fit with the participants line is
+    truncated.
+    """
+    template = '\U0001F37A <b>{}</b>\n<i>(id: {})</i>\n\n'
+    # Leave room for the participants header and the number not shown.
+    text_limit = MESSAGE_LIMIT - len(template.format('', event_id)) - 50
+    if len(event_text) > text_limit:
+        event_text = event_text[:text_limit - 1] + '\u2026'
+    text = template.format(event_text, event_id)
+    if count is None:
+        count = len(participants or ())
+    if count:
+        header = 'Идут ({}):\n'.format(count)
+        # Leave room for the number of participants not shown.
+        limit = MESSAGE_LIMIT - len(text) - len(header) - 20
+        names = []
+        for name in participants:
+            name = html.escape(name)
+            limit -= len(name) + 2
+            if limit < 0:
+                break
+            names.append(name)
+        text += header + ', '.join(names)
+        if count > len(names):
+            text += ' и еще {}'.format(count - len(names))
+        text += '\n'
     else:
         text += 'Пока никто не идет.\n'
 
@@ -43,7 +73,45 @@ def get_event_keyboard(event_id, show_switch_query=False):
     return inline_keyboard
 
 
-class EventBotCommandHandler(UpdateHandler):
+class EventUpdateHandler(UpdateHandler):
+    """Base class for pub event update handlers."""
+
+    #: Share rendered event text between processes through Redis.
+    cache_rendered_events = True
+
+    def __init__(self, api, storage, events=None, **kwargs):
+        self.events = events or EventRepository(storage)
+        super().__init__(api, storage, **kwargs)
+
+    def get_cached_event(self, event_id):
+        """Return cached ``(version, text)`` of the event or None."""
+        return rendered_events.get(event_id)
+
+    def render_event(self, event, cached=None):
+        """Render event message text, reusing cached text if possible.
+
+        ``cached`` is the ``(version, text)`` pair known before fetching
+        the event; events fetched with its version carry no participants.
+        """
+        if cached is not None and cached[0] == event.version:
+            return cached[1]
+        if event.rendered is not None:
+            text = event.rendered
+        else:
+            text = render_event_message(event.id, event.text,
+                                        event.participants,
+                                        event.participant_count)
+            if self.cache_rendered_events:
+                IOLoop.current().spawn_callback(
+                    self.events.save_rendered, event.id, event.version, text
+                )
+        latest = rendered_events.get(event.id)
+        if latest is None or latest[0] < event.version:
+            rendered_events.set(event.id, (event.version, text))
+        return text
+
+
+class EventBotCommandHandler(EventUpdateHandler):
     """Pub event message update handler."""
 
     @gen.coroutine
@@ -53,15 +121,14 @@ class EventBotCommandHandler(UpdateHandler):
                 update.chat['id'] != update.from_user['id']):
             return
 
-        state_key = 'user:{}:state'.format(update.from_user['id'])
-
         if update.bot_command == '/go':
-            self.redis.set(state_key, 'go')
+            yield self.events.start(update.from_user['id'])
             text = 'Куда и во сколько?'
-            yield self.api.send_message(update.chat['id'], text)
+            yield self.api.send_message(update.chat['id'], text,
+                                        reply=update.webhook_reply)
 
 
-class EventMessageHandler(UpdateHandler):
+class EventMessageHandler(EventUpdateHandler):
     """Pub event message update handler."""
 
     @gen.coroutine
@@ -71,131 +138,169 @@ class EventMessageHandler(UpdateHandler):
                 update.chat['id'] != update.from_user['id']):
             return
 
-        state_key = 'user:{}:state'.format(update.from_user['id'])
-
         if update.text is not None:
-            state = self.redis.get(state_key)
-            if state == 'go':
+            event = yield self.events.create(update.from_user, update.text)
+            if event is not None:
                 text = 'Договорились.'
-                self.redis.delete(state_key)
                 yield self.api.send_message(update.chat['id'], text)
 
-                event_id = self.redis.incr('event:id')
-                event_key = 'event:{}:text'.format(event_id)
-                event_text = update.text
-                self.redis.set(event_key, event_text)
-
-                user_key = 'user:{}'.format(update.from_user['id'])
-                self.redis.set(user_key, json.dumps(update.from_user))
-
-                participants_key = 'event:{}:participants'.format(event_id)
-                self.redis.sadd(participants_key, update.from_user['id'])
-
-                participants = self.redis.smembers(participants_key)
-                if participants:
-                    participants = self.redis.mget(
-                        map(lambda id: 'user:{}'.format(id), participants)
-                    )
-                text = render_event_message(event_id, event_text, participants)
-                yield self.api.send_message(
+                text = self.render_event(event)
+                message = yield self.api.send_message(
                     update.chat['id'], text,
                     parse_mode='HTML',
                     reply_markup={
-                        'inline_keyboard': get_event_keyboard(event_id, True),
+                        'inline_keyboard': get_event_keyboard(event.id, True),
                     },
                 )
+                yield self.events.add_placement(event.id, make_placement(
+                    message['chat']['id'], message['message_id']
+                ))
+
 
+class EventCallbackQueryHandler(EventUpdateHandler):
+    """Pub event callback query update handler.
 
-class EventCallbackQueryHandler(UpdateHandler):
-    """Pub event callback query update handler."""
+    A membership change refreshes every placement of the event message.
+    Message edits are debounced by ``edit_delay`` seconds, so a burst of
+    button presses results in a single edit of each placement, and carry
+    the event version, so a slower handler never overwrites a newer list
+    of participants. Placements whose message is deleted or no longer
+    accessible to the bot are forgotten.
+    """
+
+    def initialize(self, edit_delay=1.0):
+        self.edits = EditScheduler(self.api, edit_delay)
 
     @gen.coroutine
     def handle(self, update):
-        if update.data is None:
+        try:
+            event_id = int(update.action_args[0])
+        except (IndexError, ValueError):
             return
 
+        if update.message is not None:
+            pressed = make_placement(update.message['chat']['id'],
+                                     update.message['message_id'])
+        else:
+            pressed = make_placement(
+                inline_message_id=update.inline_message_id
+            )
         changed = False
-        action = update.data.split(':')
-        if (action[0] == 'event_add'):
-            try:
-                event_id = int(action[1])
-            except (IndexError, ValueError):
-                pass
-            else:
-                user_key = 'user:{}'.format(update.from_user['id'])
-                self.redis.set(user_key, json.dumps(update.from_user))
-                participants_key = 'event:{}:participants'.format(event_id)
-                changed = self.redis.sadd(participants_key,
-                                          update.from_user['id'])
-        elif (action[0] == 'event_del'):
-            try:
-                event_id = int(action[1])
-            except (IndexError, ValueError):
-                pass
-            else:
-                participants_key = 'event:{}:participants'.format(event_id)
-                changed = self.redis.srem(participants_key,
-                                          update.from_user['id'])
+        if update.action == 'event_add':
+            changed, event, placements = yield self.events.join(
+                event_id, update.from_user, pressed
+            )
+        elif update.action == 'event_del':
+            changed, event, placements = yield self.events.leave(
+                event_id, update.from_user['id'], pressed
+            )
 
         if changed:
-            event_key = 'event:{}:text'.format(event_id)
-            event_text = self.redis.get(event_key)
-            participants = self.redis.smembers(participants_key)
-            if participants:
-                participants = self.redis.mget(
-                    map(lambda id: 'user:{}'.format(id), participants)
+            text = self.render_event(event)
+            for placement in placements:
+                location = parse_placement(placement)
+                self.edits.edit_message_text(
+                    text,
+                    version=event.version,
+                    on_error=functools.partial(self.on_edit_error, event.id,
+                                               placement),
+                    parse_mode='HTML',
+                    reply_markup={
+                        'inline_keyboard': get_event_keyboard(
+                            event.id, 'inline_message_id' not in location
+                        ),
+                    },
+                    **location
                 )
-            text = render_event_message(event_id, event_text, participants)
-            yield self.api.edit_message_text(
-                text,
-                message=update.message,
-                inline_message_id=update.inline_message_id,
-                parse_mode='HTML',
-                reply_markup={
-                    'inline_keyboard': get_event_keyboard(
-                        event_id, update.message is not None
-                    ),
-                },
-            )
+
+    def on_edit_error(self, event_id, placement, error):
+        if not isinstance(error, BotApiError):
+            return
+        if (error.error_code == 403 or
+                'message to edit not found' in error.description):
+            IOLoop.current().spawn_callback(self.events.remove_placement,
+                                            event_id, placement)
 
 
-class EventInlineQueryHandler(UpdateHandler):
-    """Pub event inline query update handler."""
+class EventChosenInlineResultHandler(EventUpdateHandler):
+    """Records event messages sent with inline mode as placements.
+
+    Chosen inline results are only received if inline feedback is enabled
+    for the bot with @BotFather.
+    """
 
     @gen.coroutine
     def handle(self, update):
+        if update.inline_message_id is None:
+            return
         try:
-            event_id = int(update.query)
+            event_id = int(update.result_id)
         except ValueError:
-            pass
+            return
+        yield self.events.add_placement(event_id, make_placement(
+            inline_message_id=update.inline_message_id
+        ))
+
+
+class EventInlineQueryHandler(EventUpdateHandler):
+    """Pub event inline query update handler.
+
+    Queries are event ids; anything else, e.g. a partially typed query, is
+    ignored. Results are the same for every user, so Telegram may cache
+    them for ``cache_time`` seconds. Encoded results are also cached in
+    process by event version and reused without reading the event for
+    ``answer_ttl`` seconds, unless this process has since seen a newer
+    version.
+    """
+
+    def initialize(self, cache_time=5, answer_ttl=1.0):
+        self.cache_time = cache_time
+        self.answer_ttl = answer_ttl
+
+    @gen.coroutine
+    def handle(self, update):
+        query = update.query.strip()
+        if not query.isdecimal():
+            return
+        results = yield self.get_results(int(query))
+        if results is not None:
+            yield self.api.answer_inline_query(
+                update.id, results, cache_time=self.cache_time,
+                is_personal=False, reply=update.webhook_reply,
+            )
+
+    @gen.coroutine
+    def get_results(self, event_id):
+        """Return encoded inline query results or None if no event."""
+        now = IOLoop.current().time()
+        cached = self.get_cached_event(event_id)
+        answer = inline_answers.get(event_id)
+        if (answer is not None and now - answer[2] < self.answer_ttl and
+                (cached is None or cached[0] <= answer[0])):
+            return answer[1]
+
+        event = yield self.events.get(event_id, cached and cached[0])
+        if event is None:
+            return None
+        if answer is not None and answer[0] == event.version:
+            results = answer[1]
         else:
-            event_key = 'event:{}:text'.format(event_id)
-            event_text = self.redis.get(event_key)
-            if event_text:
-                participants_key = 'event:{}:participants'.format(event_id)
-                participants = self.redis.smembers(participants_key)
-                if participants:
-                    participants = self.redis.mget(
-                        map(lambda id: 'user:{}'.format(id), participants)
-                    )
-                text = render_event_message(event_id, event_text, participants)
-                yield self.api.answer_inline_query(
-                    update.id,
-                    [
-                        {
-                            'type': 'contact',
-                            'id': str(event_id),
-                            'phone_number': '(id: {})'.format(event_id),
-                            'first_name': event_text,
-                            'input_message_content': {
-                                'message_text': text,
-                                'parse_mode': 'HTML',
-                            },
-                            'reply_markup': {
-                                'inline_keyboard': get_event_keyboard(
-                                    event_id
-                                ),
-                            },
-                        },
-                    ],
-                )
+            results = codec.dumps([
+                {
+                    'type': 'contact',
+                    'id': str(event_id),
+                    'phone_number': '(id: {})'.format(event_id),
+                    'first_name': event.text,
+                    'input_message_content': {
+                        'message_text': self.render_event(event, cached),
+                        'parse_mode': 'HTML',
+                    },
+                    'reply_markup': {
+                        'inline_keyboard': get_event_keyboard(event_id),
+                    },
+                },
+            ])
+        latest = inline_answers.get(event_id)
+        if latest is None or latest[0] <= event.version:
+            inline_answers.set(event_id, (event.version, results, now))
+        return results
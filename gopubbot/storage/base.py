@@ -0,0 +1,76 @@
+import hashlib
+
+from tornado import gen
+
+from .exceptions import StorageReplyError
+
+
+class Storage(object):
+    """Base class for asynchronous storage backends.
+
+    Backends implement ``execute`` and ``pipeline``; every command helper
+    returns a future resolving to the command reply.
+    """
+
+    def execute(self, *args):
+        """Execute a single command."""
+        raise NotImplementedError
+
+    def pipeline(self, commands):
+        """Execute a sequence of commands in one round-trip.
+
+        Returns a future resolving to the list of replies.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def set(self, key, value, ex=None):
+        if ex is not None:
+            return self.execute('SET', key, value, 'EX', ex)
+        return self.execute('SET', key, value)
+
+    def delete(self, *keys):
+        return self.execute('DEL', *keys)
+
+    def incr(self, key):
+        return self.execute('INCR', key)
+
+    def mget(self, keys):
+        return self.execute('MGET', *keys)
+
+    def sadd(self, key, *members):
+        return self.execute('SADD', key, *members)
+
+    def srem(self, key, *members):
+        return self.execute('SREM', key, *members)
+
+    def smembers(self, key):
+        return self.execute('SMEMBERS', key)
+
+
+class Script(object):
+    """Server-side Lua script.
+
+    Scripts are invoked with EVALSHA and fall back to EVAL, which also
+    loads them into the script cache, when the server does not know them.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    @gen.coroutine
+    def __call__(self, storage, keys=(), args=()):
+        try:
+            return (yield storage.execute('EVALSHA', self.sha, len(keys),
+                                          *keys, *args))
+        except StorageReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        return (yield storage.execute('EVAL', self.source, len(keys),
+                                      *keys, *args))
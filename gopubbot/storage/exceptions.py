@@ -0,0 +1,10 @@
+class StorageError(Exception):
+    """Base storage error."""
+
+
+class StorageConnectionError(StorageError):
+    """Storage connection error."""
+
+
+class StorageReplyError(StorageError):
+    """Error reply returned by storage server."""
@@ -0,0 +1,224 @@
+import collections
+import logging
+import time
+
+import hiredis
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+from ..utils.metrics import registry
+from .base import Storage
+from .exceptions import StorageConnectionError, StorageReplyError
+
+
+redis_command_seconds = registry.histogram(
+    'gopubbot_redis_command_seconds',
+    'Redis command or pipeline time in seconds.', ('command',),
+)
+
+
+def encode_command(args):
+    """Encode command arguments using the Redis protocol."""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+class RedisConnection(object):
+    """Single pipelined Redis connection running on the IOLoop.
+
+    Commands are written to the socket as soon as they are issued and
+    replies are matched to waiting futures in order, so any number of
+    commands may be in flight at once. Commands wait until the connection
+    is authenticated and the database is selected.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 encoding='utf-8', on_close=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.encoding = encoding
+        self._on_close = on_close
+        self._stream = None
+        self._ready = False
+        self._connect_future = None
+        self._reader = hiredis.Reader(replyError=StorageReplyError,
+                                      encoding=encoding)
+        self._waiters = collections.deque()
+        self._closed = False
+
+    @property
+    def pending(self):
+        return len(self._waiters)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def connect(self):
+        if self._connect_future is None:
+            self._connect_future = self._connect()
+        return self._connect_future
+
+    @gen.coroutine
+    def _connect(self):
+        try:
+            stream = yield TCPClient().connect(self.host, self.port)
+        except (IOError, StreamClosedError) as e:
+            self._close()
+            raise StorageConnectionError(
+                'Error connecting to {}:{}: {}'.format(self.host, self.port, e)
+            )
+        stream.set_nodelay(True)
+        stream.set_close_callback(self._close)
+        self._stream = stream
+        IOLoop.current().spawn_callback(self._read_replies)
+        commands = []
+        if self.password is not None:
+            commands.append(('AUTH', self.password))
+        if self.db:
+            commands.append(('SELECT', self.db))
+        if commands:
+            try:
+                yield self._send(*commands)
+            except Exception:
+                self._close()
+                raise
+        self._ready = True
+
+    @gen.coroutine
+    def _read_replies(self):
+        reader = self._reader
+        try:
+            while True:
+                data = yield self._stream.read_bytes(65536, partial=True)
+                reader.feed(data)
+                reply = reader.gets()
+                while reply is not False:
+                    future = self._waiters.popleft()
+                    if isinstance(reply, StorageReplyError):
+                        future.set_exception(reply)
+                    else:
+                        future.set_result(reply)
+                    reply = reader.gets()
+        except StreamClosedError:
+            pass
+        except Exception:
+            logging.exception('Error reading Redis replies')
+        self._close()
+
+    def _close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._stream is not None:
+            self._stream.close()
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_exception(
+                    StorageConnectionError('Redis connection closed')
+                )
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _send(self, *commands):
+        if self._closed:
+            raise StorageConnectionError('Redis connection closed')
+        futures = []
+        for args in commands:
+            future = Future()
+            self._waiters.append(future)
+            futures.append(future)
+        self._stream.write(b''.join(encode_command(args) for args in commands))
+        return futures
+
+    @gen.coroutine
+    def execute(self, *args):
+        if not self._ready:
+            yield self.connect()
+        start = time.perf_counter()
+        try:
+            return (yield self._send(args)[0])
+        finally:
+            redis_command_seconds.labels(args[0]).observe(
+                time.perf_counter() - start
+            )
+
+    @gen.coroutine
+    def pipeline(self, commands):
+        commands = list(commands)
+        if not commands:
+            return []
+        if not self._ready:
+            yield self.connect()
+        start = time.perf_counter()
+        try:
+            return (yield self._send(*commands))
+        finally:
+            redis_command_seconds.labels('PIPELINE').observe(
+                time.perf_counter() - start
+            )
+
+    def close(self):
+        self._close()
+
+
+class RedisStorage(Storage):
+    """Redis storage backed by a bounded pool of pipelined connections."""
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 max_connections=4):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.max_connections = max_connections
+        self._connections = []
+
+    def _remove_connection(self, connection):
+        try:
+            self._connections.remove(connection)
+        except ValueError:
+            pass
+
+    def get_connection(self):
+        """Return the least loaded connection, opening a new one if needed."""
+        best = None
+        for connection in self._connections:
+            if best is None or connection.pending < best.pending:
+                best = connection
+        if best is not None and (
+                best.pending == 0 or
+                len(self._connections) >= self.max_connections):
+            return best
+        connection = RedisConnection(
+            self.host, self.port, self.db, self.password,
+            on_close=self._remove_connection,
+        )
+        self._connections.append(connection)
+        return connection
+
+    def open_connection(self):
+        """Open a connection outside the pool, e.g. for blocking commands."""
+        return RedisConnection(self.host, self.port, self.db, self.password)
+
+    def execute(self, *args):
+        return self.get_connection().execute(*args)
+
+    def pipeline(self, commands):
+        return self.get_connection().pipeline(commands)
+
+    def close(self):
+        for connection in list(self._connections):
+            connection.close()
@@ -0,0 +1,55 @@
+"""JSON codec used by the whole package.
+
+The fastest installed backend is picked on import: orjson, then ujson,
+then simplejson, which is always installed. Every backend decodes ``str``
+and ``bytes`` and encodes to compact ``str`` with non-ASCII characters
+kept as is.
+"""
+
+import collections
+
+
+Codec = collections.namedtuple('Codec', ['name', 'loads', 'dumps'])
+
+BACKENDS = ('orjson', 'ujson', 'simplejson')
+
+
+def get_codec(name):
+    """Return the codec of the backend, raising ImportError if missing."""
+    if name == 'orjson':
+        import orjson
+
+        def dumps(obj):
+            return orjson.dumps(obj).decode('utf-8')
+
+        return Codec(name, orjson.loads, dumps)
+    elif name == 'ujson':
+        import ujson
+
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False)
+
+        return Codec(name, ujson.loads, dumps)
+    elif name == 'simplejson':
+        import simplejson
+
+        def dumps(obj):
+            return simplejson.dumps(obj, ensure_ascii=False,
+                                    separators=(',', ':'))
+
+        return Codec(name, simplejson.loads, dumps)
+    raise ValueError('Unknown JSON backend: {}'.format(name))
+
+
+def get_default_codec():
+    for name in BACKENDS:
+        try:
+            return get_codec(name)
+        except ImportError:
+            pass
+    raise ImportError('No JSON backend installed')
+
+
+codec = get_default_codec()
+loads = codec.loads
+dumps = codec.dumps
@@ -0,0 +1,217 @@
+import bisect
+import math
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values)
+    ))
+
+
+def sort_key(item):
+    return tuple(str(value) for value in item[0])
+
+
+class CounterValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric(object):
+    """Metric family with values per label values.
+
+    Values are kept in a dict keyed by label values tuples, which are
+    converted to strings only when rendered, so updating a value costs a
+    dict lookup and an addition. Metrics may instead read their value from
+    ``function`` when rendered; with labels it returns a dict keyed by
+    label values tuples.
+    """
+
+    metric_type = None
+    value_class = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self._values = {}
+
+    def _make_value(self):
+        return self.value_class()
+
+    def labels(self, *values):
+        """Return the value of the label values, creating it if needed."""
+        try:
+            return self._values[values]
+        except KeyError:
+            assert len(values) == len(self.label_names)
+            value = self._values[values] = self._make_value()
+            return value
+
+    def clear(self):
+        self._values.clear()
+
+    def samples(self):
+        """Yield ``(suffix, label names, label values, value)`` tuples."""
+        if self.function is not None:
+            if not self.label_names:
+                yield '', (), (), self.function()
+                return
+            values = sorted(self.function().items(), key=sort_key)
+            for label_values, value in values:
+                yield '', self.label_names, label_values, value
+            return
+        for values, value in sorted(self._values.items(), key=sort_key):
+            yield '', self.label_names, values, value.value
+
+    def render(self, const_names=(), const_values=()):
+        """Render the metric, adding the constant labels to all samples."""
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.metric_type),
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix,
+                format_labels(const_names + names, const_values + values),
+                format_value(value)
+            ))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    metric_type = 'counter'
+    value_class = CounterValue
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """Value that goes up and down."""
+
+    metric_type = 'gauge'
+    value_class = GaugeValue
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. latencies in seconds."""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _make_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        bucket_names = self.label_names + ('le',)
+        bounds = [format_value(b) for b in self.buckets] + ['+Inf']
+        for values, value in sorted(self._values.items(), key=sort_key):
+            count = 0
+            for bound, bucket_count in zip(bounds, value.counts):
+                count += bucket_count
+                yield '_bucket', bucket_names, values + (bound,), count
+            yield '_sum', self.label_names, values, value.sum
+            yield '_count', self.label_names, values, count
+
+
+class Registry(object):
+    """Collection of metrics rendered in the Prometheus text format."""
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('Duplicate metric: {}'.format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        return self.register(Counter(name, help, labels, function))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def clear(self):
+        """Reset values of all metrics."""
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self, labels=None):
+        """Render all metrics, adding the ``labels`` dict to all samples."""
+        names = tuple(labels or ())
+        values = tuple(labels[name] for name in names)
+        return ''.join(metric.render(names, values) + '\n'
+                       for metric in self._metrics.values())
+
+
+#: Metrics of the process, updated by the bot and storage modules.
+registry = Registry()
@@ -1,15 +1,14 @@
-import codecs
-import io
 import mimetypes
 import os.path
 import uuid
 from collections import OrderedDict
 
+from tornado import gen
 
-DEFAULT_MIME_TYPE = 'application/octet-stream'
 
+DEFAULT_MIME_TYPE = 'application/octet-stream'
 
-stream_writer = codecs.getwriter('utf-8')
+DEFAULT_CHUNK_SIZE = 64 * 1024
 
 
 def render_headers(headers):
@@ -20,26 +19,30 @@ def render_headers(headers):
     return '\r\n'.join(lines).encode('utf-8')
 
 
-def encode_multipart_formdata(params, files, boundary=None):
-    """Encode a params and files using the multipart/form-data MIME format."""
-    body = io.BytesIO()
-    if boundary is None:
-        boundary = 'GoPubBotBoundary{}'.format(uuid.uuid4().hex)
+def make_boundary():
+    return 'GoPubBotBoundary{}'.format(uuid.uuid4().hex)
 
+
+def iter_parts(params, files, boundary):
+    """Yield multipart/form-data body parts.
+
+    Parts are either bytes or paths of files whose content goes there.
+    """
     for name, value in params.items():
         headers = OrderedDict([
             ('Content-Disposition', 'form-data; name="{}"'.format(name)),
         ])
-        body.write('--{}\r\n'.format(boundary).encode('utf-8'))
-        body.write(render_headers(headers))
-
-        if isinstance(value, (int, float)):
-            value = str(value)
-        elif isinstance(value, bool):
+        if isinstance(value, bool):
             value = 'true' if value else 'false'
+        elif isinstance(value, (int, float)):
+            value = str(value)
 
-        stream_writer(body).write(value)
-        body.write(b'\r\n')
+        yield b''.join([
+            '--{}\r\n'.format(boundary).encode('utf-8'),
+            render_headers(headers),
+            value.encode('utf-8'),
+            b'\r\n',
+        ])
 
     for name, file_path in files.items():
         file_name = os.path.basename(file_path)
@@ -53,15 +56,72 @@ def encode_multipart_formdata(params, files, boundary=None):
                 mimetypes.guess_type(file_path)[0] or DEFAULT_MIME_TYPE
             ),
         ])
-        body.write('--{}\r\n'.format(boundary).encode('utf-8'))
-        body.write(render_headers(headers))
+        yield b''.join([
+            '--{}\r\n'.format(boundary).encode('utf-8'),
+            render_headers(headers),
+        ])
+        yield file_path
+        yield b'\r\n'
+
+    yield '--{}--\r\n'.format(boundary).encode('utf-8')
 
-        with open(file_path, 'rb') as f:
-            body.write(f.read())
-        body.write(b'\r\n')
 
-    body.write('--{}--\r\n'.format(boundary).encode('utf-8'))
+def encode_multipart_formdata(params, files, boundary=None):
+    """Encode a params and files using the multipart/form-data MIME format."""
+    if boundary is None:
+        boundary = make_boundary()
+
+    body = []
+    for part in iter_parts(params, files, boundary):
+        if isinstance(part, bytes):
+            body.append(part)
+        else:
+            with open(part, 'rb') as f:
+                body.append(f.read())
 
     content_type = 'multipart/form-data; boundary={}'.format(boundary)
 
-    return body.getvalue(), content_type
+    return b''.join(body), content_type
+
+
+class MultipartProducer(object):
+    """Streaming multipart/form-data request body producer.
+
+    Used as a tornado ``HTTPRequest`` ``body_producer``: files are read and
+    written in chunks, so memory use does not depend on their size. The
+    body length is known in advance from file sizes.
+    """
+
+    def __init__(self, params, files, boundary=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if boundary is None:
+            boundary = make_boundary()
+        self.chunk_size = chunk_size
+        self.content_type = 'multipart/form-data; boundary={}'.format(
+            boundary
+        )
+        self.parts = list(iter_parts(params or {}, files, boundary))
+        self.content_length = sum(
+            len(part) if isinstance(part, bytes) else os.path.getsize(part)
+            for part in self.parts
+        )
+
+    @property
+    def headers(self):
+        return {
+            'Content-Type': self.content_type,
+            'Content-Length': str(self.content_length),
+        }
+
+    @gen.coroutine
+    def __call__(self, write):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield write(part)
+                continue
+            with open(part, 'rb') as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield write(chunk)